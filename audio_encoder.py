@@ -0,0 +1,82 @@
+import audio_format
+
+RATE = audio_format.RATE
+
+# encoding name -> libsndfile (format, subtype)
+FORMAT_DICT = {
+    'flac': ('FLAC', 'PCM_16'),
+    'ogg_opus': ('OGG', 'OPUS'),
+}
+
+class StreamEncoder(object):
+    """Compresses int16 PCM chunk by chunk, returning the encoded bytes produced so far.
+
+    FLAC emits a frame every 4096 samples. Ogg-Opus only emits when an Ogg page fills,
+    about once per second, which adds that much latency.
+    """
+
+    def __init__(self, encoding):
+        import soundfile
+        format, subtype = FORMAT_DICT[encoding]
+        self._sink = _StreamSink()
+        self._sound_file = soundfile.SoundFile(self._sink, 'w', samplerate=RATE, channels=1, format=format, subtype=subtype)
+
+    def encode(self, content):
+        self._sound_file.buffer_write(content, dtype='int16')
+        return self._sink.take()
+
+    def flush(self):
+        self._sound_file.close()
+        return self._sink.take()
+
+
+class _StreamSink(object):
+    """Write-only file object for libsndfile whose output is taken away as it is written.
+
+    On close libsndfile seeks back to patch the header (total length, checksum). That part is
+    already sent, so writes before the taken offset are dropped; the header then says "length
+    unknown", which is valid for streamed FLAC / Ogg.
+    """
+
+    def __init__(self):
+        self.data = bytearray() # written, not yet taken
+        self.offset = 0 # absolute position of data[0]
+        self.pos = 0
+
+    def write(self, b):
+        b = memoryview(b).cast('B')
+        size = len(b)
+        start = self.pos
+        self.pos += size
+        if self.pos <= self.offset:
+            return size
+        if start < self.offset:
+            b = b[self.offset-start:]
+            start = self.offset
+        begin = start - self.offset
+        end = begin + len(b)
+        if end > len(self.data):
+            self.data.extend(bytes(end - len(self.data)))
+        self.data[begin:end] = b
+        return size
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        else:
+            self.pos = self.offset + len(self.data) + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        return b''
+
+    def take(self):
+        ret = bytes(self.data)
+        self.offset += len(self.data)
+        self.data = bytearray()
+        return ret
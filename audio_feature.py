@@ -0,0 +1,24 @@
+import numpy as np
+
+class AudioFrame(object):
+    """One chunk of int16 PCM with its features, computed once when the chunk is captured.
+
+    The volume meter, the noise filter and the stats read these instead of re-decoding data.
+    """
+
+    __slots__ = ('data', 'time', 'ptp', 'start', 'end')
+
+    def __init__(self, data, time):
+        self.data = data
+        self.time = time
+        # sample range in the consumer's PcmRingBuffer, set when the frame is stored there
+        self.start = None
+        self.end = None
+
+        samples = np.frombuffer(data, dtype=np.int16)
+        if len(samples) <= 0:
+            self.ptp = 0
+            return
+
+        # max / min come back as numpy scalars, widen those rather than copying the chunk to int32
+        self.ptp = int(samples.max()) - int(samples.min())
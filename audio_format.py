@@ -0,0 +1,55 @@
+RATE = 16000 # Hz, mono int16 from capture to STT upload and archive
+SAMPLE_WIDTH = 2
+
+FRAME_TIME_LIST = [10, 20, 30, 100] # ms per captured frame
+DEFAULT_FRAME_TIME = 100
+
+def get_frame_size(frame_time):
+    # samples per frame of frame_time ms
+    return RATE * frame_time // 1000
+
+def ms_to_samples(ms):
+    return int(ms * RATE / 1000)
+
+
+class CaptureProfile(object):
+    """A frame size with the segmentation thresholds that go with it, applied as room config.
+
+    Thresholds are in ms and hold for any frame size, they are counted in samples. A smaller
+    frame notices speech onset sooner, and costs a callback, a queue round trip and a
+    noise filter step per frame.
+    """
+
+    def __init__(self, name, frame_time, off_on_time, on_pause_time, on_off_time):
+        self.name = name
+        self.frame_time = frame_time
+        self.off_on_time = off_on_time # pre-roll kept before the frame that triggered
+        self.on_pause_time = on_pause_time # silence still sent as part of the speech
+        self.on_off_time = on_off_time # silence that ends the utterance
+
+    def get_config_dict(self):
+        return {
+            'capture_profile': self.name,
+            'frame_time': self.frame_time,
+            'thereshold_off_on_time': self.off_on_time,
+            'thereshold_on_pause_time': self.on_pause_time,
+            'thereshold_on_off_time': self.on_off_time,
+        }
+
+
+PROFILE_LIST = [
+    # 100 callbacks / s, onset within 10 ms
+    CaptureProfile('low_latency', 10, 500, 500, 1000),
+    # the frame size common VADs work on
+    CaptureProfile('balanced', 30, 500, 500, 1000),
+    # 10 callbacks / s, onset up to 100 ms late
+    CaptureProfile('low_overhead', DEFAULT_FRAME_TIME, 500, 500, 1000),
+]
+PROFILE_DICT = {profile.name: profile for profile in PROFILE_LIST}
+DEFAULT_PROFILE = 'low_overhead'
+
+def get_capture_profile(name):
+    profile = PROFILE_DICT.get(name, None)
+    if profile is None:
+        raise ValueError('Unknown capture profile: {}'.format(name))
+    return profile
@@ -1,39 +1,79 @@
+import audio_feature
+import audio_format
+from collections import deque
 import copy
 import hashlib
 import json
-import numpy as np
+import metrics
 import pyaudio
-import collections
+from six.moves import queue
+import telemetry
+import threading
+import time
+import traceback
+import wave
 
-RATE = 16000
-CHUNK = int(RATE / 10)  # 100ms
+RATE = audio_format.RATE
+SAMPLE_WIDTH = audio_format.SAMPLE_WIDTH
+
+# in virtual clock mode, stop reading ahead when the agent has this many seconds queued
+VIRTUAL_CLOCK_MAX_BACKLOG = 5
+
+# ms of frames the PortAudio callback may hand over before the consumer thread takes them, newer ones are dropped
+HANDOFF_TIME = 5000
+
+# seconds a cached device list is trusted before the device topology is checked again
+DEVICE_TOPOLOGY_CHECK_INTERVAL = 5
 
 class AudioListener(object):
 
-    def __init__(self, runtime):
-        self.runtime = runtime
-        self.init_args = runtime.init_args
+    def __init__(self, room):
+        self.room = room
+        self.runtime = room.runtime
+        self.init_args = room.init_args
 
         self._audio_interface = None
         self._audio_stream = None
-        self._vol_history = collections.deque()
+
+        # fixed while capturing, a new frame_time applies from the next start
+        self.frame_time = room.frame_time
+        self.frame_size = audio_format.get_frame_size(self.frame_time)
+        # the meter keeps its 10 Hz whatever the frame size, the loudest frame of each interval
+        self.vol_frame_count = max(1, telemetry.VOL_INTERVAL // self.frame_time)
+        self._vol_frame_index = 0
+        self._vol_max = 0
+
+        # PortAudio callback -> consumer thread, single producer / single consumer.
+        # SimpleQueue.put never blocks and is reentrant, the callback touches nothing else that is shared.
+        self._handoff_queue = queue.SimpleQueue() # (in_data, time_info, callback time), None at stop
+        self._handoff_capacity = max(1, HANDOFF_TIME // self.frame_time)
+        self._callback_duration_deque = deque(maxlen=self._handoff_capacity)
+        self._overflow_count = 0 # written by the callback only
+        self._handoff_drop_count = 0 # written by the callback only
+        self._consumer_thread = None
+        self.reported_overflow_count = 0
+        self.reported_handoff_drop_count = 0
 
     def start(self):
         print('Starting audio listener...')
         assert(self._audio_stream is None)
         assert(self._audio_interface is None)
 
-        audio_input_device_list = get_audio_input_device_list()
-        audio_input_device_list = filter(lambda info: info['hash']==self.runtime.audio_input_device_hash, audio_input_device_list)
-        audio_input_device_list = list(audio_input_device_list)
+        registry = self.runtime.audio_input_device_registry
+        info = registry.get_device(self.room.audio_input_device_hash)
+        if info is None:
+            # may have been plugged in since the last probe
+            info = registry.get_device(self.room.audio_input_device_hash, refresh=True)
 
-        if len(audio_input_device_list) <= 0:
+        if info is None:
             print('No audio input device found')
             return False
         
+        self._consumer_thread = threading.Thread(target=self._consume, name='AudioConsumer-{}'.format(self.room.room_id))
+        self._consumer_thread.start()
+
         self._audio_interface = pyaudio.PyAudio()
 
-        info = audio_input_device_list[0]
         print(info)
 
         self._audio_stream = self._audio_interface.open(
@@ -42,11 +82,12 @@ class AudioListener(object):
             rate=RATE,
             input=True,
             input_device_index = info['index'],
-            frames_per_buffer=CHUNK,
+            frames_per_buffer=self.frame_size,
             stream_callback=self._stream_callback,
         )
+        registry.add_open_stream()
 
-        self.runtime.update_status('audio_input_device', info['name'])
+        self.room.update_status('audio_input_device', info['name'])
 
         print('Audio listener started')
 
@@ -58,31 +99,277 @@ class AudioListener(object):
             self._audio_stream = None
             self._audio_interface.terminate()
             self._audio_interface = None
-        if self.runtime.translation_agent is not None:
-            self.runtime.translation_agent.on_audio_listener_stopped()
+            self.runtime.audio_input_device_registry.remove_open_stream()
+        if self._consumer_thread is not None:
+            # the stream is closed, the consumer drains what is left and exits
+            self._handoff_queue.put(None)
+            self._consumer_thread.join()
+            self._consumer_thread = None
+        if self.room.translation_agent is not None:
+            self.room.translation_agent.on_audio_listener_stopped()
         print('Audio listener stopped')
 
     def _stream_callback(self, in_data, frame_count, time_info, status_flags):
-        vol = self._cal_vol(in_data)
-        self._vol_history.append(vol)
-        if len(self._vol_history) > 10:
-            self._vol_history.popleft()
-        self.runtime.update_status('vol', vol)
-        if self.runtime.running:
-            if self.runtime.translation_agent is not None:
-                self.runtime.translation_agent.on_audio_listener_data(in_data)
+        # PortAudio thread: no lock, no logging, no status, only the handoff
+        start = time.perf_counter()
+        if status_flags & pyaudio.paInputOverflow:
+            self._overflow_count += 1
+        if self._handoff_queue.qsize() < self._handoff_capacity:
+            self._handoff_queue.put((in_data, time_info, time.time()))
+        else:
+            self._handoff_drop_count += 1
+        self._callback_duration_deque.append(time.perf_counter() - start)
         return None, pyaudio.paContinue
 
-    def _cal_vol(self, in_data):
-        in_data_np = np.frombuffer(in_data, dtype=np.int16)
-        in_data_np = in_data_np.astype(np.int32)
-        return int(in_data_np.max() - in_data_np.min())
+    def _consume(self):
+        try:
+            room_id = self.room.room_id
+            while True:
+                # None comes after everything handed over before stop()
+                item = self._handoff_queue.get()
+                if item is not None:
+                    in_data, time_info, callback_time = item
+                    self._on_audio_data(in_data, get_capture_time(callback_time, time_info))
+                while len(self._callback_duration_deque) > 0:
+                    metrics.AUDIO_CALLBACK_DURATION.observe(self._callback_duration_deque.popleft(), room_id)
+                self._update_overrun_stat()
+                if item is None: break
+        except:
+            traceback.print_exc()
+
+    def _update_overrun_stat(self):
+        # counted by the callback, published here
+        overflow_count = self._overflow_count
+        handoff_drop_count = self._handoff_drop_count
+        if overflow_count == self.reported_overflow_count and handoff_drop_count == self.reported_handoff_drop_count:
+            return
+        metrics.AUDIO_INPUT_OVERFLOW_COUNT.inc(self.room.room_id, value=overflow_count - self.reported_overflow_count)
+        metrics.AUDIO_HANDOFF_DROP_COUNT.inc(self.room.room_id, value=handoff_drop_count - self.reported_handoff_drop_count)
+        self.reported_overflow_count = overflow_count
+        self.reported_handoff_drop_count = handoff_drop_count
+        self.room.update_status_dict({
+            'audio_input_overflow': overflow_count,
+            'audio_handoff_dropped': handoff_drop_count,
+        })
+
+    def _on_audio_data(self, in_data, sample_time):
+        frame = audio_feature.AudioFrame(in_data, sample_time)
+        self._vol_max = max(self._vol_max, frame.ptp)
+        self._vol_frame_index += 1
+        if self._vol_frame_index >= self.vol_frame_count:
+            self.room.vol_telemetry.push(sample_time, self._vol_max)
+            self._vol_frame_index = 0
+            self._vol_max = 0
+        if self.runtime.running:
+            if self.room.translation_agent is not None:
+                self.room.translation_agent.on_audio_listener_data(frame)
+
+class FileAudioListener(AudioListener):
+    """Replays a WAV or raw PCM (16 kHz mono int16) file in place of a capture device.
+
+    With virtual_clock the file is fed as fast as the TranslationAgent consumes it,
+    otherwise frames are paced at real time.
+    """
+
+    def __init__(self, room, path, virtual_clock=False):
+        super().__init__(room)
+        self.path = path
+        self.virtual_clock = virtual_clock
+        self.audio_time = 0
+
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        print('Starting file audio listener...')
+        assert(self._thread is None)
+
+        self._running = True
+        self.audio_time = 0
+        self._thread = threading.Thread(target=self.run)
+        self._thread.start()
+
+        self.room.update_status('audio_input_device', self.path)
+
+        print('File audio listener started')
+
+    def stop(self):
+        print('Stopping file audio listener...')
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.room.translation_agent is not None:
+            self.room.translation_agent.on_audio_listener_stopped()
+        print('File audio listener stopped')
+
+    def run(self):
+        try:
+            start_time = time.time()
+            frame_count = 0
+            with open_pcm_file(self.path) as pcm_file:
+                while self._running:
+                    in_data = pcm_file.read(self.frame_size)
+                    if len(in_data) <= 0:
+                        break
+                    if len(in_data) < self.frame_size * SAMPLE_WIDTH:
+                        in_data += bytes(self.frame_size * SAMPLE_WIDTH - len(in_data))
+
+                    if self.virtual_clock:
+                        self._wait_backlog()
+                    else:
+                        # like a device, a frame is delivered once its last sample is recorded
+                        delay = start_time + (frame_count + 1) * self.frame_size / RATE - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+                    if not self._running:
+                        break
+
+                    self._on_audio_data(in_data, start_time + self.audio_time)
+                    frame_count += 1
+                    self.audio_time = frame_count * self.frame_size / RATE
+
+            print('File audio listener reached end of file: {:.1f}s in {:.1f}s'.format(self.audio_time, time.time() - start_time))
+            self.room.update_status('audio_time', self.audio_time)
+            if self._running and self.room.translation_agent is not None:
+                self.room.translation_agent.on_audio_listener_stopped()
+        except:
+            traceback.print_exc()
+
+    def _wait_backlog(self):
+        while self._running:
+            translation_agent = self.room.translation_agent
+            if translation_agent is None: return
+            if translation_agent.audio_buffer.get_time() < VIRTUAL_CLOCK_MAX_BACKLOG: return
+            time.sleep(0.001)
+
+
+class RawPcmFile(object):
 
-def get_audio_input_device_list():
-    audio_interface = pyaudio.PyAudio()
-    ret = _get_audio_input_device_list(audio_interface)
-    audio_interface.terminate()
-    return ret
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def read(self, frame_count):
+        return self._file.read(frame_count * SAMPLE_WIDTH)
+
+    def close(self):
+        self._file.close()
+
+
+class WavPcmFile(object):
+
+    def __init__(self, path):
+        self._wave = wave.open(path, 'rb')
+        if self._wave.getnchannels() != 1 or self._wave.getsampwidth() != SAMPLE_WIDTH or self._wave.getframerate() != RATE:
+            self._wave.close()
+            raise ValueError('{}: expected {} Hz mono 16-bit wav'.format(path, RATE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def read(self, frame_count):
+        return self._wave.readframes(frame_count)
+
+    def close(self):
+        self._wave.close()
+
+
+def get_capture_time(callback_time, time_info):
+    # time_info is on the stream's own clock, only the input latency it gives is used
+    latency = time_info.get('current_time', 0) - time_info.get('input_buffer_adc_time', 0)
+    if 0 < latency < 1:
+        return callback_time - latency
+    return callback_time
+
+def open_pcm_file(path):
+    if path.lower().endswith('.wav'):
+        return WavPcmFile(path)
+    return RawPcmFile(path)
+
+
+def create_audio_listener(room):
+    if room.input_file:
+        return FileAudioListener(room, room.input_file, room.virtual_clock)
+    return AudioListener(room)
+
+
+class AudioInputDeviceRegistry(object):
+    """The usable audio input devices, kept between probes, with lookup by device hash.
+
+    Probing every device with is_format_supported is slow, so it only happens on an explicit
+    refresh, or when a cheap listing shows the device topology changed. That check itself runs
+    at most every DEVICE_TOPOLOGY_CHECK_INTERVAL seconds.
+
+    PortAudio only scans devices in the first Pa_Initialize, later PyAudio() instances share
+    that scan while any instance is alive. So while a room is capturing, neither the topology
+    check nor a refresh could see a hot-plugged device; the cached list is returned as it is
+    until every stream is closed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.device_list = None
+        self.device_dict = {} # hash -> info
+        self.topology = None
+        self.check_time = 0
+        self.open_stream_count = 0
+
+    def add_open_stream(self):
+        with self.lock:
+            self.open_stream_count += 1
+
+    def remove_open_stream(self):
+        with self.lock:
+            self.open_stream_count -= 1
+
+    def get_device_list(self, refresh=False):
+        with self.lock:
+            self._update(refresh)
+            return list(self.device_list)
+
+    def get_device(self, device_hash, refresh=False):
+        with self.lock:
+            self._update(refresh)
+            return self.device_dict.get(device_hash, None)
+
+    def _update(self, refresh):
+        # caller holds lock
+        now = time.time()
+        if not refresh and self.device_list is not None:
+            if now - self.check_time < DEVICE_TOPOLOGY_CHECK_INTERVAL:
+                return
+        if self.open_stream_count > 0 and self.device_list is not None:
+            # PortAudio would answer from its scan at initialization, see above
+            return
+        audio_interface = pyaudio.PyAudio()
+        try:
+            topology = _get_audio_device_topology(audio_interface)
+            if refresh or self.device_list is None or topology != self.topology:
+                print('Probing audio input devices')
+                self.device_list = _get_audio_input_device_list(audio_interface)
+                self.device_dict = {info['hash']: info for info in self.device_list}
+                self.topology = topology
+        finally:
+            audio_interface.terminate()
+        self.check_time = now
+
+
+def _get_audio_device_topology(audio_interface):
+    # cheap listing, no format probing
+    topology = []
+    for i in range(audio_interface.get_device_count()):
+        info = audio_interface.get_device_info_by_index(i)
+        topology.append((info['name'], info['hostApi'], info['maxInputChannels']))
+    return topology
 
 def _get_audio_input_device_list(audio_interface):
     device_list = []
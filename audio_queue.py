@@ -0,0 +1,95 @@
+import audio_format
+from collections import deque
+import metrics
+import threading
+import time
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DROP_SILENCE = 'drop_silence'
+POLICY_CATCH_UP = 'catch_up'
+POLICY_LIST = [POLICY_DROP_OLDEST, POLICY_DROP_SILENCE, POLICY_CATCH_UP]
+
+class AudioQueue(object):
+    """Bounded queue of AudioFrame between the capture thread and the TranslationAgent.
+
+    put() never blocks the capture thread. The capacity is room.audio_queue_time seconds of
+    audio, whatever the frame size. When the queue is full, room is made according to
+    room.audio_queue_policy:
+    - drop_oldest: drop the oldest frame
+    - drop_silence: drop the oldest frame below thereshold_on_off_vol, else the oldest frame
+    - catch_up: drop everything queued and continue from the live edge
+    None is the end of stream marker and is never dropped.
+    """
+
+    def __init__(self, room, max_sample_count):
+        self.room = room
+        self.max_sample_count = max_sample_count
+        self.lock = threading.Condition()
+        self.frame_deque = deque()
+        self.frame_count = 0 # frames in frame_deque, not counting None
+        self.sample_count = 0 # samples in those frames
+        self.drop_count = 0
+        self.late_count = 0
+
+    def put(self, frame):
+        with self.lock:
+            if frame is not None:
+                capacity = min(int(self.room.audio_queue_time * audio_format.RATE), self.max_sample_count)
+                while self.frame_count > 0 and self.sample_count >= capacity:
+                    self._make_room()
+                self.frame_count += 1
+                self.sample_count += frame.end - frame.start
+            self.frame_deque.append(frame)
+            frame_count = self.frame_count
+            self.lock.notify()
+        metrics.AUDIO_QUEUE_DEPTH.observe(frame_count, self.room.room_id)
+
+    def get(self):
+        with self.lock:
+            while len(self.frame_deque) <= 0:
+                self.lock.wait()
+            frame = self.frame_deque.popleft()
+            if frame is None:
+                return None
+            self.frame_count -= 1
+            self.sample_count -= frame.end - frame.start
+            wait_time = time.time() - frame.time
+            if wait_time > self.room.audio_late_time:
+                self.late_count += 1
+        if not self.room.virtual_clock:
+            metrics.AUDIO_QUEUE_WAIT.observe(wait_time, self.room.room_id)
+        return frame
+
+    def qsize(self):
+        return len(self.frame_deque)
+
+    def get_time(self):
+        # seconds of audio queued
+        return self.sample_count / audio_format.RATE
+
+    def _make_room(self):
+        # caller holds lock
+        policy = self.room.audio_queue_policy
+        if policy == POLICY_CATCH_UP:
+            self.drop_count += self.frame_count
+            self.frame_count = 0
+            self.sample_count = 0
+            # keep end of stream markers only
+            self.frame_deque = deque(frame for frame in self.frame_deque if frame is None)
+            return
+        if policy == POLICY_DROP_SILENCE:
+            for i, frame in enumerate(self.frame_deque):
+                if frame is None: continue
+                if frame.ptp < self.room.thereshold_on_off_vol:
+                    del self.frame_deque[i]
+                    self.frame_count -= 1
+                    self.sample_count -= frame.end - frame.start
+                    self.drop_count += 1
+                    return
+        for i, frame in enumerate(self.frame_deque):
+            if frame is None: continue
+            del self.frame_deque[i]
+            self.frame_count -= 1
+            self.sample_count -= frame.end - frame.start
+            self.drop_count += 1
+            return
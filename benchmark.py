@@ -0,0 +1,291 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+import numpy as np
+
+import audio_format
+import main
+import runtime
+import translation_agent
+
+RATE = audio_format.RATE
+SAMPLE_WIDTH = audio_format.SAMPLE_WIDTH
+CELL = RATE // 100 # samples per 10 ms cell when comparing segmentations
+
+class BenchmarkAgent(translation_agent.TranslationAgent):
+    """The real TranslationAgent, also recording what it segmented and when it published.
+
+    segment_list holds the [start, end) samples sent to STT for each utterance and
+    segment_time_list the capture time of its last audio. latency_list is the age at each publish
+    of the last audio the text covers (what MIC_TO_TEXT observes), final_latency_list the time from
+    the last audio of an utterance to its final subtitle, hangover and recognizer included.
+    drained is set once the end of the input has been consumed and the last utterance finished.
+    """
+
+    def __init__(self, room):
+        super().__init__(room)
+        self.segment_list = []
+        self.segment_time_list = []
+        self.latency_list = []
+        self.final_latency_list = []
+        self.end_of_input = threading.Event()
+        self.drained = threading.Event()
+
+    def audio_generator(self):
+        # back at the top of the loop, the utterance holding the end of the input is done
+        if self.end_of_input.is_set():
+            self.drained.set()
+        return super().audio_generator()
+
+    def _audio_buffer_generator(self):
+        yield from super()._audio_buffer_generator()
+        self.end_of_input.set()
+
+    def _join_data_generator(self, generator):
+        return super()._join_data_generator(self._segment_generator(generator))
+
+    def _segment_generator(self, generator):
+        segment = None
+        for span in generator:
+            if segment is None:
+                segment = [span.start, span.end]
+                self.segment_list.append(segment)
+                self.segment_time_list.append(None)
+            segment[1] = span.end
+            # spans are yielded as soon as their frame is read, so it is the newest one
+            self.segment_time_list[-1] = self.last_frame_time
+            yield span
+
+    def _publish_text(self, language_code, transcript, is_final, capture_time):
+        super()._publish_text(language_code, transcript, is_final, capture_time)
+        now = time.time()
+        if capture_time is not None:
+            self.latency_list.append(now - capture_time)
+        # the fake backend gives one final per utterance, in order
+        if is_final and len(self.final_latency_list) < len(self.segment_time_list):
+            self.final_latency_list.append(now - self.segment_time_list[len(self.final_latency_list)])
+
+
+def make_synthetic_corpus(path, utterance_count, seed):
+    """Write utterance_count voiced bursts separated by silence, return their (start, end) in seconds.
+
+    Bursts are harmonic tones with a syllable-rate envelope over a low noise floor, 0.5-4 s
+    long; gaps are 0.3-3 s, so some fall below the hangover and merge as they would in speech.
+    """
+    random = np.random.RandomState(seed)
+    part_list = [random.normal(0, 60, RATE)] # 1 s lead-in
+    label_list = []
+    position = RATE
+    for i in range(utterance_count):
+        length = int(random.uniform(0.5, 4) * RATE)
+        t = np.arange(length) / RATE
+        f0 = random.uniform(100, 250)
+        tone = sum(np.sin(2 * np.pi * f0 * k * t + random.uniform(0, 2 * np.pi)) / k for k in range(1, 6))
+        envelope = 0.6 + 0.4 * np.abs(np.sin(np.pi * random.uniform(3, 5) * t))
+        part_list.append(7000 * envelope * tone / 1.5 + random.normal(0, 60, length))
+        label_list.append((position / RATE, (position + length) / RATE))
+        position += length
+
+        length = int(random.uniform(0.3, 3) * RATE) if i < utterance_count - 1 else 2 * RATE
+        part_list.append(random.normal(0, 60, length))
+        position += length
+
+    samples = np.clip(np.concatenate(part_list), -32768, 32767).astype(np.int16)
+    with wave.open(path, 'wb') as wave_file:
+        wave_file.setnchannels(1)
+        wave_file.setsampwidth(SAMPLE_WIDTH)
+        wave_file.setframerate(RATE)
+        wave_file.writeframes(samples.tobytes())
+    return label_list
+
+def load_label_list(path):
+    # Audacity label track: start<TAB>end[<TAB>label] in seconds, one segment per line
+    label_list = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            field_list = line.strip().split('\t')
+            if len(field_list) < 2 or field_list[0].startswith('\\'):
+                continue
+            label_list.append((float(field_list[0]), float(field_list[1])))
+    return label_list
+
+def get_segmentation(segment_list, label_list, sample_count):
+    # agreement of detected and labelled speech over 10 ms cells
+    cell_count = sample_count // CELL
+    detected = np.zeros(cell_count, dtype=bool)
+    for start, end in segment_list:
+        detected[start // CELL:end // CELL] = True
+    reference = np.zeros(cell_count, dtype=bool)
+    for start, end in label_list:
+        reference[int(start * RATE) // CELL:int(end * RATE) // CELL] = True
+    hit = np.count_nonzero(detected & reference)
+    return {
+        'cell_accuracy': float(np.count_nonzero(detected == reference) / max(cell_count, 1)),
+        'speech_precision': float(hit / max(np.count_nonzero(detected), 1)),
+        'speech_recall': float(hit / max(np.count_nonzero(reference), 1)),
+        'reference_utterance_count': len(label_list),
+    }
+
+def get_percentile_dict(value_list):
+    if len(value_list) <= 0:
+        return None
+    return {
+        'count': len(value_list),
+        'p50': float(np.percentile(value_list, 50)),
+        'p99': float(np.percentile(value_list, 99)),
+    }
+
+def run_corpus(args, name, path, label_list):
+    init_args = main.create_arg_parser().parse_args([
+        '0', args.language_code, str(args.speech_threshold),
+        '--input-file', path,
+        '--stt', 'fake', '--stt-fake-latency', str(args.stt_latency),
+        '--capture-profile', args.capture_profile,
+    ] + (['--frame-time', str(args.frame_time)] if args.frame_time else [])
+      + (['--virtual-clock'] if args.virtual_clock else []))
+    r = runtime.Runtime(init_args)
+    room = r.get_room()
+    agent = BenchmarkAgent(room)
+    room.translation_agent = agent
+
+    r.running = True
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    room.enable()
+    while not agent.drained.wait(timeout=1):
+        if not r.running: break # the agent failed
+    audio_time = room.audio_listener.audio_time
+    room.disable()
+    cpu_time = time.process_time() - cpu_start
+    wall_time = time.time() - wall_start
+    r.running = False
+
+    ret = {
+        'name': name,
+        'audio_time': audio_time,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'throughput': audio_time / cpu_time if cpu_time > 0 else None, # audio seconds per CPU second
+        'utterance_count': len(agent.segment_list),
+        'byte_sent': room.stat_byte_sent,
+        'byte_sent_wire': room.stat_byte_sent_wire,
+        'audio_dropped': agent.audio_buffer.drop_count,
+        'segmentation': None,
+        # frame times are synthetic under the virtual clock
+        'latency': None if args.virtual_clock else get_percentile_dict(agent.latency_list),
+        'final_latency': None if args.virtual_clock else get_percentile_dict(agent.final_latency_list),
+    }
+    if label_list is not None:
+        ret['segmentation'] = get_segmentation(agent.segment_list, label_list, int(audio_time * RATE))
+    return ret, agent
+
+def get_peak_rss():
+    # bytes, None where resource is not available (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    corpus_list = [] # (name, path, label_list or None)
+    for path in args.corpus:
+        label_path = os.path.splitext(path)[0] + '.txt'
+        label_list = load_label_list(label_path) if os.path.exists(label_path) else None
+        corpus_list.append((os.path.basename(path), path, label_list))
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        if args.synthetic_count > 0:
+            path = os.path.join(temp_dir, 'synthetic.wav')
+            label_list = make_synthetic_corpus(path, args.synthetic_count, args.seed)
+            corpus_list.insert(0, ('synthetic-{}-{}'.format(args.synthetic_count, args.seed), path, label_list))
+
+        result_list = []
+        latency_list = []
+        final_latency_list = []
+        # the pipeline logs to stdout, keep it for the result
+        with contextlib.redirect_stdout(sys.stderr):
+            for name, path, label_list in corpus_list:
+                result, agent = run_corpus(args, name, path, label_list)
+                result_list.append(result)
+                latency_list.extend(agent.latency_list)
+                final_latency_list.extend(agent.final_latency_list)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    audio_time = sum(result['audio_time'] for result in result_list)
+    cpu_time = sum(result['cpu_time'] for result in result_list)
+    return {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'config': {
+            'language_code': args.language_code,
+            'speech_threshold': args.speech_threshold,
+            'stt_latency': args.stt_latency,
+            'capture_profile': args.capture_profile,
+            'frame_time': args.frame_time or audio_format.get_capture_profile(args.capture_profile).frame_time,
+            'virtual_clock': args.virtual_clock,
+        },
+        'corpus_list': result_list,
+        'total': {
+            'audio_time': audio_time,
+            'cpu_time': cpu_time,
+            'throughput': audio_time / cpu_time if cpu_time > 0 else None,
+            'byte_sent': sum(result['byte_sent'] for result in result_list),
+            'byte_sent_wire': sum(result['byte_sent_wire'] for result in result_list),
+            'latency': None if args.virtual_clock else get_percentile_dict(latency_list),
+            'final_latency': None if args.virtual_clock else get_percentile_dict(final_latency_list),
+        },
+        'peak_rss': get_peak_rss(),
+    }
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description=(
+        'Replay speech / silence corpora through the TranslationAgent pipeline against the fake '
+        'STT backend and print throughput, segmentation, bytes sent, peak RSS and latency as JSON.'
+    ))
+    parser.add_argument('--corpus', type=str, action='append', default=[], help='Recorded 16 kHz mono wav, labelled by an Audacity label file of the same name (.txt) if present, repeatable')
+    parser.add_argument('--synthetic-count', type=int, default=20, help='Utterances in the generated corpus, 0 for none')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the generated corpus')
+    parser.add_argument('--stt-latency', type=float, default=0.3, help='Seconds the fake backend takes to answer each request')
+    parser.add_argument('--virtual-clock', action='store_true', help='Feed as fast as the pipeline consumes, latency is not reported')
+    parser.add_argument('--capture-profile', type=str, default=audio_format.DEFAULT_PROFILE, choices=[profile.name for profile in audio_format.PROFILE_LIST])
+    parser.add_argument('--frame-time', type=int, default=None, choices=audio_format.FRAME_TIME_LIST, help='Overrides the profile frame size')
+    parser.add_argument('--language-code', type=str, default='en-US')
+    parser.add_argument('--speech-threshold', type=int, default=5000)
+    parser.add_argument('--output', type=str, default='', help='Write the JSON here instead of stdout')
+    return parser
+
+def benchmark_main():
+    args = create_arg_parser().parse_args()
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    benchmark_main()
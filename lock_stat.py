@@ -0,0 +1,48 @@
+import threading
+import time
+
+class MeasuredCondition(threading.Condition):
+    """threading.Condition that counts how often entering it had to block, and for how long.
+
+    Only `with cond:` is measured; the re-acquire inside wait() is not.
+    """
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.acquire_count = 0
+        self.contended_count = 0
+        self.contended_time = 0.0
+        self.wait_count = 0
+        self.notify_count = 0
+
+    def __enter__(self):
+        if self._lock.acquire(blocking=False):
+            self.acquire_count += 1
+            return True
+        start = time.perf_counter()
+        ret = self._lock.acquire()
+        self.acquire_count += 1
+        self.contended_count += 1
+        self.contended_time += time.perf_counter() - start
+        return ret
+
+    def wait(self, timeout=None):
+        ret = super().wait(timeout)
+        self.wait_count += 1
+        return ret
+
+    def notify(self, n=1):
+        self.notify_count += 1
+        super().notify(n)
+
+    def get_stat(self):
+        # plain counter reads, no need to take the lock being measured
+        return {
+            'name': self.name,
+            'acquire_count': self.acquire_count,
+            'contended_count': self.contended_count,
+            'contended_time': self.contended_time,
+            'wait_count': self.wait_count,
+            'notify_count': self.notify_count,
+        }
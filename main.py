@@ -1,13 +1,33 @@
 import argparse
+import audio_format
 
-def main():
+def create_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('port', type=int, help='Port to listen on')
-    parser.add_argument('language_code', type=str, help='Language code')
+    parser.add_argument('language_code', type=str, help='Language code, comma separated for one subtitle channel per language (e.g. en-US,ja-JP)')
     parser.add_argument('speech_threshold', type=int, default=5000, nargs='?')
     parser.add_argument('speech_timeout', type=float, default=1, nargs='?')
+    parser.add_argument('--capture-profile', type=str, default=audio_format.DEFAULT_PROFILE, choices=[profile.name for profile in audio_format.PROFILE_LIST], help='Frame size and segmentation thresholds, low_latency notices speech sooner for more per-frame work')
+    parser.add_argument('--frame-time', type=int, default=None, choices=audio_format.FRAME_TIME_LIST, help='Capture frame size in ms, overrides the profile')
     parser.add_argument('--device', type=str, default='', nargs='?')
-    args = parser.parse_args()
+    parser.add_argument('--room', type=str, action='append', default=[], metavar='ROOM_ID=DEVICE', help='Extra room capturing from DEVICE, served under /room/ROOM_ID/, repeatable')
+    parser.add_argument('--input-file', type=str, default='', help='Replay a WAV / raw PCM file instead of capturing')
+    parser.add_argument('--virtual-clock', action='store_true', help='Replay --input-file as fast as possible')
+    parser.add_argument('--stt', type=str, default='google', choices=['google', 'vosk', 'fake'], help='Speech-to-text backend, fake answers locally after --stt-fake-latency')
+    parser.add_argument('--stt-model', type=str, default='', help='Model directory for the offline (vosk) backend, comma separated in language_code order')
+    parser.add_argument('--stt-fake-latency', type=float, default=0.3, help='Seconds the fake backend takes to answer each request')
+    parser.add_argument('--translate-to', type=str, default='', help='Comma separated target language codes, each translated from the first language_code into its own subtitle channel')
+    parser.add_argument('--translator', type=str, default='google', choices=['google', 'local'], help='Translation backend, local is a phrase table stand-in for testing')
+    parser.add_argument('--translator-model', type=str, default='', help='JSON phrase table for the local translator')
+    parser.add_argument('--translation-cache-path', type=str, default='', help='Keep the phrase translation cache in this file across restarts')
+    parser.add_argument('--history-path', type=str, default='', help='Keep finalized subtitles in this SQLite file, served by /history')
+    parser.add_argument('--trace', action='store_true', help='Record pipeline spans from the start, download them from the admin page')
+    parser.add_argument('--sample-storage-path', type=str, default='', help='Archive every utterance as wav under this directory')
+    parser.add_argument('--stt-encoding', type=str, default='linear16', choices=['linear16', 'flac', 'ogg_opus'], help='Upload encoding for the google backend, flac / ogg_opus need soundfile')
+    return parser
+
+def main():
+    args = create_arg_parser().parse_args()
     
     import runtime
     runtime.run(args)
@@ -0,0 +1,118 @@
+import bisect
+import threading
+
+LATENCY_BUCKET_LIST = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CALLBACK_BUCKET_LIST = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05)
+DEPTH_BUCKET_LIST = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+METRIC_LIST = [] # every metric, in the order they are rendered
+
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name, help, label_name_list=()):
+        self.name = name
+        self.help = help
+        self.label_name_list = label_name_list
+        self.lock = threading.Lock()
+        self.value_dict = {} # label values -> count
+        METRIC_LIST.append(self)
+
+    def inc(self, *label_value_list, value=1):
+        with self.lock:
+            self.value_dict[label_value_list] = self.value_dict.get(label_value_list, 0) + value
+
+    def render(self, line_list):
+        with self.lock:
+            item_list = sorted(self.value_dict.items())
+        for label_value_list, value in item_list:
+            line_list.append('{}{} {}'.format(self.name, _format_labels(self.label_name_list, label_value_list), value))
+
+
+class Histogram(object):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, label_name_list=(), bucket_list=LATENCY_BUCKET_LIST):
+        self.name = name
+        self.help = help
+        self.label_name_list = label_name_list
+        self.bucket_list = bucket_list
+        self.lock = threading.Lock()
+        self.value_dict = {} # label values -> [bucket counts (not cumulative) + +Inf, sum]
+        METRIC_LIST.append(self)
+
+    def observe(self, value, *label_value_list):
+        i = bisect.bisect_left(self.bucket_list, value)
+        with self.lock:
+            data = self.value_dict.get(label_value_list, None)
+            if data is None:
+                data = [[0] * (len(self.bucket_list) + 1), 0.0]
+                self.value_dict[label_value_list] = data
+            data[0][i] += 1
+            data[1] += value
+
+    def render(self, line_list):
+        with self.lock:
+            item_list = sorted((k, (list(v[0]), v[1])) for k, v in self.value_dict.items())
+        for label_value_list, (count_list, total) in item_list:
+            count = 0
+            for bound, bucket_count in zip(self.bucket_list + ('+Inf',), count_list):
+                count += bucket_count
+                labels = _format_labels(self.label_name_list + ('le',), label_value_list + (str(bound),))
+                line_list.append('{}_bucket{} {}'.format(self.name, labels, count))
+            labels = _format_labels(self.label_name_list, label_value_list)
+            line_list.append('{}_sum{} {}'.format(self.name, labels, total))
+            line_list.append('{}_count{} {}'.format(self.name, labels, count))
+
+
+def render():
+    # Prometheus text exposition format
+    line_list = []
+    for metric in METRIC_LIST:
+        line_list.append('# HELP {} {}'.format(metric.name, metric.help))
+        line_list.append('# TYPE {} {}'.format(metric.name, metric.type))
+        metric.render(line_list)
+    return '\n'.join(line_list) + '\n'
+
+def _format_labels(label_name_list, label_value_list):
+    if len(label_name_list) <= 0:
+        return ''
+    pair_list = []
+    for name, value in zip(label_name_list, label_value_list):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pair_list.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(pair_list) + '}'
+
+
+AUDIO_CALLBACK_DURATION = Histogram(
+    'subtitle_audio_callback_seconds', 'Time spent in the PortAudio callback',
+    ('room',), CALLBACK_BUCKET_LIST,
+)
+AUDIO_QUEUE_DEPTH = Histogram(
+    'subtitle_audio_queue_depth', 'Frames in the audio queue after a put',
+    ('room',), DEPTH_BUCKET_LIST,
+)
+AUDIO_QUEUE_WAIT = Histogram(
+    'subtitle_audio_queue_wait_seconds', 'Time from capture to leaving the audio queue',
+    ('room',),
+)
+SPEECH_ONSET_TO_FIRST_REQUEST = Histogram(
+    'subtitle_speech_onset_to_first_request_seconds', 'Time from the frame that triggered an utterance to its first audio sent to STT',
+    ('room',),
+)
+REQUEST_TO_FIRST_RESULT = Histogram(
+    'subtitle_request_to_first_result_seconds', 'Time from the first audio sent on an STT stream to its first result',
+    ('room', 'lang'),
+)
+MIC_TO_TEXT = Histogram(
+    'subtitle_mic_to_text_seconds', 'Time from the capture of the last audio a subtitle covers to its publish',
+    ('room', 'lang'),
+)
+AUDIO_INPUT_OVERFLOW_COUNT = Counter('subtitle_audio_input_overflows_total', 'Callbacks PortAudio flagged with paInputOverflow', ('room',))
+AUDIO_HANDOFF_DROP_COUNT = Counter('subtitle_audio_handoff_drops_total', 'Frames dropped in the callback because the consumer thread fell behind', ('room',))
+UTTERANCE_COUNT = Counter('subtitle_utterances_total', 'Utterances sent to STT', ('room',))
+STT_STREAM_OPEN_COUNT = Counter('subtitle_stt_streams_opened_total', 'STT streams opened, prewarmed and rollover included', ('room', 'lang'))
+LONG_POLL_WAKEUP_COUNT = Counter('subtitle_long_poll_wakeups_total', 'Long-polls woken by a change before their timeout', ('route',))
+HTTP_REQUEST_COUNT = Counter('subtitle_http_requests_total', 'HTTP requests served', ('route', 'code'))
@@ -0,0 +1,56 @@
+import numpy as np
+
+class PcmSpan(object):
+    """Range [start, end) of absolute sample indexes in a PcmRingBuffer."""
+
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class PcmRingBuffer(object):
+    """Preallocated int16 ring for captured audio, addressed by absolute sample index.
+
+    One producer writes each chunk once; readers get memoryviews into the ring instead of
+    copies, and must consume them before the producer wraps around (capacity samples later).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = np.zeros(capacity, dtype=np.int16)
+        self.end = 0 # absolute index one past the newest sample
+
+    def write(self, data):
+        samples = np.frombuffer(data, dtype=np.int16)
+        sample_count = len(samples)
+        assert(sample_count <= self.capacity)
+        pos = self.end % self.capacity
+        first_count = min(sample_count, self.capacity - pos)
+        self.buf[pos:pos+first_count] = samples[:first_count]
+        self.buf[:sample_count-first_count] = samples[first_count:]
+        start = self.end
+        self.end += sample_count
+        return PcmSpan(start, self.end)
+
+    def get_start(self):
+        # oldest absolute index still held
+        return max(0, self.end - self.capacity)
+
+    def is_valid(self, span):
+        return span.start >= self.get_start() and span.end <= self.end
+
+    def view_list(self, start, end):
+        # byte memoryviews over [start, end), two of them when the range wraps
+        if start >= end:
+            return []
+        assert(start >= self.get_start() and end <= self.end)
+        pos = start % self.capacity
+        sample_count = end - start
+        if pos + sample_count <= self.capacity:
+            return [memoryview(self.buf[pos:pos+sample_count]).cast('B')]
+        return [
+            memoryview(self.buf[pos:]).cast('B'),
+            memoryview(self.buf[:pos+sample_count-self.capacity]).cast('B'),
+        ]
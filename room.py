@@ -0,0 +1,281 @@
+import collections
+import os
+import time
+import audio_format
+import audio_listener
+import lock_stat
+from six.moves import queue
+import sample_storage
+import telemetry
+import tracing
+import translation_agent
+
+DEFAULT_ROOM_ID = 'default'
+STAT_PUBLISH_INTERVAL = 1.0 # seconds, byte counters reach the status at most this often
+
+class TextChannel(object):
+    """Subtitle text of one language in a room, guarded by the room's text_lock."""
+
+    def __init__(self, language_code):
+        self.language_code = language_code
+        self.text = ''
+        self.text_version = 0
+        self.subscriber_set = set()
+
+
+class Room:
+    """One capture pipeline: an AudioListener + TranslationAgent pair with its own device,
+    thresholds, subtitle text and status. Runtime holds any number of these side by side.
+
+    main_lock and running are shared with the Runtime, everything else is per room.
+    Each recognized language in language_code_list and each translation target has its own
+    TextChannel, the first recognized language is the default.
+    """
+
+    def __init__(self, runtime, room_id, device, input_file):
+        self.runtime = runtime
+        self.init_args = runtime.init_args
+        self.room_id = room_id
+        self.device = device
+        self.input_file = input_file
+        # a file fed as fast as it is consumed, frame times run ahead of the clock
+        self.virtual_clock = bool(input_file) and self.init_args.virtual_clock
+
+        # main_lock   - control plane, shared by every room
+        # text_lock   - text channels: text, text_version, text subscribers
+        # status_lock - status dict, status_version, status subscribers, byte stats
+        self.main_lock = runtime.main_lock
+        self.text_lock = lock_stat.MeasuredCondition('{}.text'.format(room_id))
+        self.status_lock = lock_stat.MeasuredCondition('{}.status'.format(room_id))
+
+        self.language_code_list = self.init_args.language_code.split(',')
+        self.text_channel_dict = collections.OrderedDict((language_code, TextChannel(language_code)) for language_code in self.language_code_list)
+        if runtime.translator is not None:
+            for language_code in runtime.translator.target_language_code_list:
+                if language_code not in self.text_channel_dict:
+                    self.text_channel_dict[language_code] = TextChannel(language_code)
+        self.status = {} # for web server to get value, no use in server side logic
+        self.status_version = 0
+        self.status_change_log = collections.OrderedDict() # key -> status_version of last change, oldest change first
+        self.vol_telemetry = telemetry.VolTelemetry(name='{}.telemetry'.format(room_id)) # own lock, the 10 Hz meter stays out of status
+        self.status_subscriber_set = set()
+        self.audio_input_device_hash = ''
+        self.stat_byte_sent = 0
+        self.stat_byte_sent_wire = 0
+        self.stat_publish_time = 0
+
+        self.audio_listener = None
+        self.translation_agent = None
+        self.sample_storage = None
+        if self.init_args.sample_storage_path:
+            self.sample_storage = sample_storage.SampleStorage(os.path.join(self.init_args.sample_storage_path, room_id))
+
+        self.update_status('room_id', room_id)
+        self.update_status('operation','OFF')
+        config_dict = {
+            'capture_profile': self.init_args.capture_profile,
+            'thereshold_off_on_vol': self.init_args.speech_threshold,
+            'thereshold_on_off_vol': self.init_args.speech_threshold,
+            'audio_queue_time': 10.0,
+            'audio_queue_policy': 'drop_oldest',
+            'audio_late_time': 1.0,
+            'stt_prewarm': 1,
+            'stt_rollover_overlap_time': 2.0,
+            'subtitle_interim_interval': 0.2,
+            'subtitle_min_stability': 0.5,
+        }
+        if self.init_args.frame_time:
+            config_dict['frame_time'] = self.init_args.frame_time
+        self.set_config_dict(config_dict)
+
+    @property
+    def running(self):
+        return self.runtime.running
+
+    def start(self):
+        if self.sample_storage is not None:
+            self.sample_storage.start()
+        self.load_audio_input_device_hash()
+
+    def stop(self):
+        self.disable()
+        if self.sample_storage is not None:
+            self.sample_storage.stop()
+
+    def enable(self):
+        self.update_status('operation','> ON')
+        with self.main_lock:
+            if self.audio_listener is None:
+                self.audio_listener = audio_listener.create_audio_listener(self)
+            if self.translation_agent is None:
+                self.translation_agent = translation_agent.TranslationAgent(self)
+
+            self.translation_agent.start()
+            self.audio_listener.start()
+        self.update_status('operation','ON')
+
+    def disable(self):
+        self.update_status('operation','> OFF')
+        with self.main_lock:
+            if self.audio_listener is not None:
+                self.audio_listener.stop()
+                self.audio_listener = None
+            if self.translation_agent is not None:
+                self.translation_agent.stop()
+                self.translation_agent = None
+        self.flush_stat()
+        self.update_status('operation','OFF')
+
+    def set_audio_input_device_hash(self, audio_input_device_hash):
+        with self.main_lock:
+            self.audio_input_device_hash = audio_input_device_hash
+            self.update_status('audio_input_device_hash', audio_input_device_hash)
+
+    def get_text_channel(self, language_code=None):
+        # None for the default language, returns None for a language this room does not serve
+        if language_code is None:
+            language_code = self.language_code_list[0]
+        return self.text_channel_dict.get(language_code, None)
+
+    def update_text(self, text, language_code=None, is_final=False):
+        with tracing.TRACER.span('update_text'):
+            text_channel = self.get_text_channel(language_code)
+            if is_final and self.runtime.transcript_history is not None:
+                self.runtime.transcript_history.submit(time.time(), self.room_id, text_channel.language_code, text)
+            with self.text_lock:
+                text_channel.text = text
+                text_channel.text_version += 1
+                for subscriber in text_channel.subscriber_set:
+                    subscriber.put(text)
+                self.text_lock.notify_all()
+            if text_channel.language_code == self.language_code_list[0]:
+                self.update_status('subtitle', text)
+            else:
+                self.update_status('subtitle_' + text_channel.language_code, text)
+
+    def update_status(self, key, value):
+        print('Update status: {}.{} = {} START'.format(self.room_id, key, value))
+        with self.status_lock:
+            self._set_status(key, value)
+            for subscriber in self.status_subscriber_set:
+                subscriber.put({key: value})
+            self.status_lock.notify_all()
+        print('Update status: {}.{} = {} END'.format(self.room_id, key, value))
+
+    def update_status_dict(self, status_dict):
+        with self.status_lock:
+            for key, value in status_dict.items():
+                self._set_status(key, value)
+            for subscriber in self.status_subscriber_set:
+                subscriber.put(dict(status_dict))
+            self.status_lock.notify_all()
+
+    def _set_status(self, key, value):
+        self.status_version += 1
+        self.status[key] = value
+        self.status_change_log[key] = self.status_version
+        self.status_change_log.move_to_end(key)
+
+    def get_status_since(self, since):
+        # caller holds status_lock
+        if since <= 0:
+            return dict(self.status)
+        ret = {}
+        for key in reversed(self.status_change_log):
+            if self.status_change_log[key] <= since: break
+            ret[key] = self.status[key]
+        return ret
+
+    # Push channels: a subscriber is anything with put(), by default a new queue. It is primed
+    # with the current value, then receives every change, called under the channel's lock.
+
+    def subscribe_text(self, language_code=None, subscriber=None):
+        text_channel = self.get_text_channel(language_code)
+        if subscriber is None:
+            subscriber = queue.Queue()
+        with self.text_lock:
+            subscriber.put(text_channel.text)
+            text_channel.subscriber_set.add(subscriber)
+        return subscriber
+
+    def unsubscribe_text(self, subscriber, language_code=None):
+        text_channel = self.get_text_channel(language_code)
+        with self.text_lock:
+            text_channel.subscriber_set.discard(subscriber)
+
+    def subscribe_status(self, subscriber=None):
+        if subscriber is None:
+            subscriber = queue.Queue()
+        with self.status_lock:
+            subscriber.put(dict(self.status))
+            self.status_subscriber_set.add(subscriber)
+        return subscriber
+
+    def unsubscribe_status(self, subscriber):
+        with self.status_lock:
+            self.status_subscriber_set.discard(subscriber)
+
+    def set_config_dict(self, config_dict):
+        # a capture_profile stands for its frame_time and thresholds, keys given with it win.
+        # frame_time applies from the next enable.
+        if 'capture_profile' in config_dict:
+            profile = audio_format.get_capture_profile(config_dict['capture_profile'])
+            config_dict = dict(profile.get_config_dict(), **config_dict)
+        if 'frame_time' in config_dict and config_dict['frame_time'] not in audio_format.FRAME_TIME_LIST:
+            raise ValueError('Unsupported frame_time: {}'.format(config_dict['frame_time']))
+        with self.main_lock:
+            for key, value in config_dict.items():
+                setattr(self, key, value)
+            self.update_status_dict(config_dict)
+
+    def load_audio_input_device_hash(self):
+        if self.device is None:
+            return
+        if self.input_file:
+            return
+        init_device = self.device
+        audio_input_device_list = self.runtime.audio_input_device_registry.get_device_list()
+        audio_input_device_list = filter(lambda info: init_device in info['name'], audio_input_device_list)
+        audio_input_device_list = list(audio_input_device_list)
+        if len(audio_input_device_list) == 0:
+            print('No audio input device found')
+            return
+        print(audio_input_device_list[0])
+        self.set_audio_input_device_hash(audio_input_device_list[0]['hash'])
+
+    # byte_sent (raw PCM) and byte_sent_wire (after upload encoding) are both counted per STT
+    # stream, so with N languages each is N times the audio, and they compare like for like.
+    # Byte counters change with every chunk and upload. They are published to the status
+    # at most every STAT_PUBLISH_INTERVAL, and by flush_stat() when an utterance is done.
+
+    def update_stat(self, content_len):
+        with self.status_lock:
+            self.stat_byte_sent += content_len
+            self._publish_stat(False)
+
+    def update_wire_stat(self, content_len):
+        # bytes actually uploaded, after compression
+        with self.status_lock:
+            self.stat_byte_sent_wire += content_len
+            self._publish_stat(False)
+
+    def flush_stat(self):
+        with self.status_lock:
+            self._publish_stat(True)
+
+    def _publish_stat(self, force):
+        # caller holds status_lock
+        now = time.time()
+        if not force and now - self.stat_publish_time < STAT_PUBLISH_INTERVAL:
+            return
+        self.stat_publish_time = now
+        if self.status.get('byte_sent', None) == self.stat_byte_sent and self.status.get('byte_sent_wire', None) == self.stat_byte_sent_wire:
+            return
+        self.update_status_dict({
+            'byte_sent': self.stat_byte_sent,
+            'time_sent': self.stat_byte_sent/audio_format.RATE/audio_format.SAMPLE_WIDTH,
+            'byte_sent_wire': self.stat_byte_sent_wire,
+        })
+
+    def get_lock_stat_list(self):
+        return [lock.get_stat() for lock in (self.text_lock, self.status_lock, self.vol_telemetry.lock)]
@@ -1,9 +1,11 @@
-import hashlib
-import json
+import collections
 # import stt
 import audio_listener
-import threading
-import translation_agent
+import lock_stat
+import room
+import tracing
+import transcript_history
+import translator
 import web_server
 
 class Runtime:
@@ -11,32 +13,42 @@ class Runtime:
     def __init__(self, init_args):
         self.init_args = init_args
 
+        # main_lock is the control plane shared by every room: running, enable / disable,
+        # device selection, config. Each Room has its own text and status locks.
+        self.main_lock = lock_stat.MeasuredCondition('main')
+
         self.running = False
-        self.text = ''
-        self.text_md5 = hashlib.md5(self.text.encode('utf-8')).hexdigest()
-        self.main_lock = threading.Condition()
-        self.status = {} # for web server to get value, no use in server side logic
-        self.status_hash = hashlib.md5(json.dumps(self.status).encode('utf-8')).hexdigest()
-        self.audio_input_device_hash = ''
-        self.stat_byte_sent = 0
-
-        self.audio_listener = None
-        self.translation_agent = None
-
-        self.update_status('operation','OFF')
-        self.set_config_dict({
-            'thereshold_off_on_vol': self.init_args.speech_threshold,
-            'thereshold_off_on_time': 5,
-            'thereshold_on_off_vol': self.init_args.speech_threshold,
-            'thereshold_on_pause_time': 5,
-            'thereshold_on_off_time': 10,
-        })
+        tracing.TRACER.set_enabled(self.init_args.trace)
+        self.audio_input_device_registry = audio_listener.AudioInputDeviceRegistry()
+        self.translator = translator.create_translator(self.init_args) # None without --translate-to
+        self.transcript_history = None
+        if self.init_args.history_path:
+            self.transcript_history = transcript_history.TranscriptHistory(self.init_args.history_path)
+
+        self.room_dict = collections.OrderedDict() # room_id -> Room
+        self.add_room(room.DEFAULT_ROOM_ID, self.init_args.device, self.init_args.input_file)
+        for room_arg in self.init_args.room:
+            room_id, _, device = room_arg.partition('=')
+            self.add_room(room_id, device, '')
+
+    def add_room(self, room_id, device, input_file):
+        if room_id in self.room_dict:
+            raise ValueError('Duplicate room: {}'.format(room_id))
+        self.room_dict[room_id] = room.Room(self, room_id, device, input_file)
+        return self.room_dict[room_id]
+
+    def get_room(self, room_id=room.DEFAULT_ROOM_ID):
+        return self.room_dict.get(room_id, None)
 
     def run(self):
         try:
             self.running = True
 
-            self.load_audio_input_device_hash()
+            if self.transcript_history is not None:
+                self.transcript_history.start()
+
+            for r in self.room_dict.values():
+                r.start()
 
             self.start_web_server()
 
@@ -46,9 +58,16 @@ class Runtime:
         finally:
             self.running = False
 
-            self.disable()
+            for r in self.room_dict.values():
+                r.stop()
             self.stop_web_server()
 
+            if self.transcript_history is not None:
+                self.transcript_history.stop()
+
+            if self.translator is not None:
+                self.translator.cache.save()
+
         # self.stop_speech_to_text()
 
     def start_web_server(self):
@@ -58,34 +77,6 @@ class Runtime:
     def stop_web_server(self):
         self.web_server.stop()
 
-    def enable(self):
-        self.update_status('operation','> ON')
-        with self.main_lock:
-            if self.audio_listener is None:
-                self.audio_listener = audio_listener.AudioListener(self)
-            if self.translation_agent is None:
-                self.translation_agent = translation_agent.TranslationAgent(self)
-
-            self.translation_agent.start()
-            self.audio_listener.start()
-        self.update_status('operation','ON')
-
-    def disable(self):
-        self.update_status('operation','> OFF')
-        with self.main_lock:
-            if self.audio_listener is not None:
-                self.audio_listener.stop()
-                self.audio_listener = None
-            if self.translation_agent is not None:
-                self.translation_agent.stop()
-                self.translation_agent = None
-        self.update_status('operation','OFF')
-
-    def set_audio_input_device_hash(self, audio_input_device_hash):
-        with self.main_lock:
-            self.audio_input_device_hash = audio_input_device_hash
-            self.update_status('audio_input_device_hash', audio_input_device_hash)
-
     # def start_audio_listener(self):
     #     self.audio_listener = audio_listener.AudioListener(self)
     #     self.audio_listener.start()
@@ -112,55 +103,11 @@ class Runtime:
             # print('Keyboard interrupt')
             # self.running = False
 
-    def update_text(self, text):
-        with self.main_lock:
-            self.text = text
-            self.text_md5 = hashlib.md5(self.text.encode('utf-8')).hexdigest()
-            self.update_status('subtitle', text)
-            self.main_lock.notify()
-
-    def update_status(self, key, value):
-        print('Update status: {} = {} START'.format(key, value))
-        with self.main_lock:
-            self.status[key] = value
-            status_json = json.dumps(self.status)
-            self.status_hash = hashlib.md5(status_json.encode('utf-8')).hexdigest()
-            self.main_lock.notify()
-        print('Update status: {} = {} END'.format(key, value))
-
-    def update_status_dict(self, status_dict):
-        with self.main_lock:
-            self.status.update(status_dict)
-            status_json = json.dumps(self.status)
-            self.status_hash = hashlib.md5(status_json.encode('utf-8')).hexdigest()
-            self.main_lock.notify()
-
-    def set_config_dict(self, config_dict):
-        with self.main_lock:
-            for key, value in config_dict.items():
-                setattr(self, key, value)
-            self.update_status_dict(config_dict)
-
-    def load_audio_input_device_hash(self):
-        if self.init_args.device is None:
-            return
-        init_device = self.init_args.device
-        audio_input_device_list = audio_listener.get_audio_input_device_list()
-        audio_input_device_list = filter(lambda info: init_device in info['name'], audio_input_device_list)
-        audio_input_device_list = list(audio_input_device_list)
-        if len(audio_input_device_list) == 0:
-            print('No audio input device found')
-            return
-        print(audio_input_device_list[0])
-        self.set_audio_input_device_hash(audio_input_device_list[0]['hash'])
-
-    def update_stat(self, content_len):
-        with self.main_lock:
-            self.stat_byte_sent += content_len
-            self.update_status_dict({
-                'byte_sent': self.stat_byte_sent,
-                'time_sent': self.stat_byte_sent/audio_listener.RATE/2,
-            })
+    def get_lock_stat_list(self):
+        ret = [self.main_lock.get_stat()]
+        for r in self.room_dict.values():
+            ret.extend(r.get_lock_stat_list())
+        return ret
 
 
 def run(init_args):
@@ -0,0 +1,143 @@
+import audio_format
+import bisect
+import io
+import json
+import os
+from six.moves import queue
+import threading
+import time
+import traceback
+import wave
+
+RATE = audio_format.RATE
+SAMPLE_WIDTH = audio_format.SAMPLE_WIDTH
+INDEX_FILENAME = 'index.jsonl'
+MAX_READ_TIME = 600 # seconds, longest range read_range() will assemble
+
+class SampleStorage(object):
+    """Append-only archive of every utterance, written by a background thread.
+
+    Layout under path:
+    - YYYYMMDD-HH/<start time>.wav : one file per utterance, a new directory every hour
+    - index.jsonl : one line per utterance {start_time, duration, file, transcript}, in write order
+
+    The index is kept in memory sorted by start_time, so a time range is found with a bisect.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entry_list = [] # sorted by start_time
+        self.start_time_list = [] # start_time of entry_list, for bisect
+        self.max_duration = 0.0
+        self.write_queue = queue.Queue()
+        self.thread = None
+
+        os.makedirs(self.path, exist_ok=True)
+        self._load_index()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.write_queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def submit(self, start_time, data, transcript):
+        # data must be a private copy, it is written later from the storage thread
+        self.write_queue.put((start_time, data, transcript))
+
+    def run(self):
+        with open(os.path.join(self.path, INDEX_FILENAME), 'a', encoding='utf-8') as index_file:
+            while True:
+                item = self.write_queue.get()
+                if item is None: break
+                try:
+                    entry = self._write_sample(*item)
+                    index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                    index_file.flush()
+                    self._add_entry(entry)
+                except:
+                    traceback.print_exc()
+
+    def lookup(self, start_time, end_time):
+        # entries overlapping [start_time, end_time)
+        ret = []
+        with self.lock:
+            i = bisect.bisect_left(self.start_time_list, end_time)
+            min_start_time = start_time - self.max_duration
+            while i > 0:
+                i -= 1
+                entry = self.entry_list[i]
+                if entry['start_time'] < min_start_time: break
+                if entry['start_time'] + entry['duration'] > start_time:
+                    ret.append(entry)
+        ret.reverse()
+        return ret
+
+    def read_range(self, start_time, end_time):
+        # PCM of [start_time, end_time), silence where nothing was recorded
+        end_time = min(end_time, start_time + MAX_READ_TIME)
+        sample_count = max(0, int((end_time - start_time) * RATE))
+        buf = bytearray(sample_count * SAMPLE_WIDTH)
+        for entry in self.lookup(start_time, end_time):
+            with wave.open(os.path.join(self.path, entry['file']), 'rb') as f:
+                data = f.readframes(f.getnframes())
+            offset = int(round((entry['start_time'] - start_time) * RATE))
+            begin = max(0, -offset)
+            end = min(len(data) // SAMPLE_WIDTH, sample_count - offset)
+            if begin >= end: continue
+            buf[(offset+begin)*SAMPLE_WIDTH:(offset+end)*SAMPLE_WIDTH] = data[begin*SAMPLE_WIDTH:end*SAMPLE_WIDTH]
+        return bytes(buf)
+
+    def read_range_wav(self, start_time, end_time):
+        ret = io.BytesIO()
+        with wave.open(ret, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(SAMPLE_WIDTH)
+            f.setframerate(RATE)
+            f.writeframes(self.read_range(start_time, end_time))
+        return ret.getvalue()
+
+    def _write_sample(self, start_time, data, transcript):
+        local_time = time.localtime(start_time)
+        dirname = time.strftime('%Y%m%d-%H', local_time)
+        filename = '{}-{:03d}.wav'.format(time.strftime('%Y%m%d-%H%M%S', local_time), int(start_time * 1000) % 1000)
+        os.makedirs(os.path.join(self.path, dirname), exist_ok=True)
+        file = dirname + '/' + filename
+        with wave.open(os.path.join(self.path, file), 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(SAMPLE_WIDTH)
+            f.setframerate(RATE)
+            f.writeframes(data)
+        return {
+            'start_time': start_time,
+            'duration': len(data) / SAMPLE_WIDTH / RATE,
+            'file': file,
+            'transcript': transcript,
+        }
+
+    def _add_entry(self, entry):
+        with self.lock:
+            i = bisect.bisect_right(self.start_time_list, entry['start_time'])
+            self.start_time_list.insert(i, entry['start_time'])
+            self.entry_list.insert(i, entry)
+            self.max_duration = max(self.max_duration, entry['duration'])
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILENAME)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) <= 0: continue
+                try:
+                    self._add_entry(json.loads(line))
+                except ValueError:
+                    # a torn last line after a crash
+                    traceback.print_exc()
@@ -3,12 +3,13 @@ import threading
 import traceback
 import pyaudio
 from six.moves import queue
-from google.cloud import speech
+import audio_feature
+import audio_format
+import stt_backend
 import time
-import numpy as np
 
-RATE = 16000
-CHUNK = int(RATE / 10)  # 100ms
+RATE = audio_format.RATE
+CHUNK = audio_format.get_frame_size(audio_format.DEFAULT_FRAME_TIME)
 
 class SpeechToText(object):
 
@@ -32,17 +33,7 @@ class SpeechToText(object):
 
     def run(self):
         try:
-            client = speech.SpeechClient()
-            config = speech.RecognitionConfig(
-                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-                sample_rate_hertz=RATE,
-                language_code=self.init_args.language_code,
-            )
-
-            streaming_config = speech.StreamingRecognitionConfig(
-                config=config, interim_results=True
-            )
-
+            backend = stt_backend.create_stt_backend(self.init_args)
 
             with MicrophoneStream(RATE, CHUNK, self) as stream:
 
@@ -60,19 +51,14 @@ class SpeechToText(object):
 
                     print('Processing...')
 
-                    requests = (
-                        speech.StreamingRecognizeRequest(audio_content=content)
-                        for content in audio_generator
-                    )
-
                     with self.main_lock:
                         if not self.runtime.running:
                             break
 
-                    responses = client.streaming_recognize(streaming_config, requests)
+                    results = backend.streaming_recognize(audio_generator)
 
-                    # Now, put the transcription responses to use.
-                    self.listen_print_loop(responses)
+                    # Now, put the transcription results to use.
+                    self.listen_print_loop(results)
 
                     print('Finished listening')
 
@@ -88,26 +74,15 @@ class SpeechToText(object):
                 self.runtime.main_lock.notify()
 
 
-    def listen_print_loop(self, responses):
-        for response in responses:
+    def listen_print_loop(self, results):
+        for result in results:
 
             if not self.runtime.running:
                 break
 
             # print('Got response')
 
-            if not response.results:
-                continue
-
-            # The `results` list is consecutive. For streaming, we only care about
-            # the first result being considered, since once it's `is_final`, it
-            # moves on to considering the next utterance.
-            result = response.results[0]
-            if not result.alternatives:
-                continue
-
-            # Display the transcription of the top alternative.
-            transcript = result.alternatives[0].transcript
+            transcript = result.transcript
 
             print(transcript)
 
@@ -235,11 +210,7 @@ class MicrophoneStream(object):
 
             data = b"".join(data)
 
-            data_np = np.frombuffer(data, dtype=np.int16)
-            data_np = data_np.astype(np.int32)
-            data_diff = np.max(data_np) - np.min(data_np)
-
-            data_busy = data_diff > self._stt.init_args.speech_threshold
+            data_busy = audio_feature.AudioFrame(data, time.time()).ptp > self._stt.init_args.speech_threshold
 
             with self._stt.main_lock:
                 state = self._stt.state
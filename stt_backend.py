@@ -0,0 +1,380 @@
+import audio_encoder
+import audio_format
+import bisect
+from collections import deque
+import json
+import re
+from six.moves import queue
+import threading
+import time
+import traceback
+import tracing
+
+RATE = audio_format.RATE
+SAMPLE_WIDTH = audio_format.SAMPLE_WIDTH
+
+# seconds of audio queued for a stream before send() waits for the recognizer
+MAX_BACKLOG_TIME = 5
+
+class SttResult(object):
+
+    def __init__(self, transcript, is_final, stability=0.0, segment_list=None, audio_end=None):
+        self.transcript = transcript
+        self.is_final = is_final
+        self.stability = stability
+        # [(transcript, stability)] making up transcript, stable first; 0 stability is unknown
+        self.segment_list = segment_list if segment_list is not None else [(transcript, stability)]
+        self.audio_end = audio_end # seconds of the stream's audio the result covers, None if unknown
+        self.capture_time = None # when the last audio it covers was captured, set by SttSession
+
+
+def _get_token_list(text, by_word):
+    # [(start, end)] of each word, or of each character for text written without spaces
+    if by_word:
+        return [m.span() for m in re.finditer(r'\S+', text)]
+    return [(i, i + 1) for i, c in enumerate(text) if not c.isspace()]
+
+def _normalize_token(token):
+    return token.lower().strip('.,!?;:')
+
+def trim_overlap(previous_transcript, result):
+    """Drop the head of result that repeats the tail of previous_transcript.
+
+    The stream replacing an expiring one is sent the last audio of the old stream again, so its
+    first words are often the old stream's last words.
+    """
+    by_word = ' ' in previous_transcript.strip() or ' ' in result.transcript.strip()
+    previous_span_list = _get_token_list(previous_transcript, by_word)
+    span_list = _get_token_list(result.transcript, by_word)
+    previous_token_list = [_normalize_token(previous_transcript[s:e]) for s, e in previous_span_list]
+    token_list = [_normalize_token(result.transcript[s:e]) for s, e in span_list]
+    # an early interim may not have reached the end of the replayed audio yet
+    count = len(token_list)
+    if count > 0 and any(previous_token_list[i:i + count] == token_list for i in range(len(previous_token_list) - count + 1)):
+        return SttResult('', result.is_final, result.stability, [], result.audio_end)
+    for n in range(min(len(previous_token_list), len(token_list)), 0, -1):
+        if previous_token_list[-n:] == token_list[:n]:
+            break
+    else:
+        return result
+    offset = span_list[n][0] if n < len(span_list) else len(result.transcript)
+    segment_list = []
+    for transcript, stability in result.segment_list:
+        if offset >= len(transcript):
+            offset -= len(transcript)
+            continue
+        segment_list.append((transcript[offset:], stability))
+        offset = 0
+    return SttResult(''.join(t for t, _ in segment_list), result.is_final, result.stability, segment_list, result.audio_end)
+
+
+class SttSession(object):
+    """One recognizer stream that can be opened before there is any audio to send.
+
+    The stream runs in its own thread and reads audio pushed with send() until close().
+    on_result(session, result) and on_sent(wire_byte_count) are called from that thread.
+    send() waits while MAX_BACKLOG_TIME of audio is queued, so a stalled recognizer backs up
+    into the room's AudioQueue, where the drop policy and counters apply. It stops waiting
+    once is_running() is False.
+
+    send() takes the capture time of the content's last sample; every result is given the
+    capture_time of the last audio it covers, from its audio_end, or else from the audio read
+    so far.
+
+    A session opened with previous_session replaces it at rollover and is first sent the
+    previous session's last audio again; until its first final, the words already given by
+    previous_session are trimmed from its results.
+    """
+
+    def __init__(self, backend, on_result, on_sent=None, is_running=None, previous_session=None):
+        self.backend = backend
+        self.on_result = on_result
+        self.on_sent = on_sent
+        self.is_running = is_running
+        self.lock = threading.Condition()
+        self.request_deque = deque() # audio content, None at the end
+        self.backlog_time = 0.0 # seconds of audio in request_deque
+        self.open_time = time.time()
+        self.first_audio_time = None
+        self.first_result_time = None
+        self.audio_time = 0.0 # seconds of audio sent
+        self.read_audio_time = 0.0 # seconds of audio read by the backend
+        self.capture_position_list = [] # audio_time after each dated send, for bisect
+        self.capture_time_list = [] # capture time of the last sample of each dated send
+        self.final_transcript_list = []
+        self.previous_session = previous_session
+        self.last_transcript = ''
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='SttSession')
+        self.thread.start()
+
+    def send(self, content, capture_time=None):
+        # content must not change afterwards, pass a copy rather than a view of pcm_buffer
+        content_time = len(content) / SAMPLE_WIDTH / RATE
+        with self.lock:
+            while self.backlog_time >= MAX_BACKLOG_TIME and not self.closed:
+                if self.is_running is not None and not self.is_running(): break
+                self.lock.wait(timeout=0.1)
+            if self.closed: return
+            if self.first_audio_time is None:
+                self.first_audio_time = time.time()
+            self.audio_time += content_time
+            self.backlog_time += content_time
+            if capture_time is not None:
+                self.capture_position_list.append(self.audio_time)
+                self.capture_time_list.append(capture_time)
+            self.request_deque.append(content)
+            self.lock.notify_all()
+
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+            self.request_deque.append(None)
+            self.lock.notify_all()
+
+    def join(self):
+        self.thread.join()
+
+    def is_usable(self):
+        # still open, and not idle for so long that the provider would drop it
+        if self.closed or not self.thread.is_alive():
+            return False
+        if self.first_audio_time is not None or self.backend.max_idle_time is None:
+            return True
+        return time.time() - self.open_time < self.backend.max_idle_time
+
+    def is_expiring(self):
+        if self.backend.max_session_time is None:
+            return False
+        return self.audio_time >= self.backend.max_session_time
+
+    def run(self):
+        try:
+            tracer = tracing.TRACER
+            response_generator = self.backend.streaming_recognize(self._request_generator(), self.on_sent)
+            for result in tracer.trace_generator('streaming_recognize', response_generator):
+                if self.first_result_time is None:
+                    self.first_result_time = time.time()
+                if self.previous_session is not None:
+                    result = trim_overlap(self.previous_session.last_transcript, result)
+                    if result.is_final:
+                        self.previous_session = None
+                    if len(result.transcript.strip()) <= 0:
+                        continue # nothing past what the previous session already gave
+                result.capture_time = self._get_capture_time(result.audio_end)
+                self.last_transcript = result.transcript
+                if result.is_final:
+                    self.final_transcript_list.append(result.transcript)
+                with tracer.span('on_stt_result'):
+                    self.on_result(self, result)
+        except:
+            traceback.print_exc()
+        # the stream is gone, make sure it is not handed out again or waited for
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def _get_capture_time(self, audio_end):
+        # capture time of the first dated send reaching audio_end, the last one past the end
+        with self.lock:
+            if audio_end is None:
+                audio_end = self.read_audio_time
+            if len(self.capture_time_list) <= 0:
+                return None
+            i = bisect.bisect_left(self.capture_position_list, audio_end - 1e-6)
+            return self.capture_time_list[min(i, len(self.capture_time_list) - 1)]
+
+    def _request_generator(self):
+        while True:
+            with self.lock:
+                while len(self.request_deque) <= 0:
+                    self.lock.wait()
+                content = self.request_deque.popleft()
+                if content is not None:
+                    self.backlog_time -= len(content) / SAMPLE_WIDTH / RATE
+                    self.read_audio_time += len(content) / SAMPLE_WIDTH / RATE
+                self.lock.notify_all()
+            if content is None: return
+            yield content
+
+
+class GoogleSttBackend(object):
+    """Google Cloud Speech-to-Text streaming recognizer (network)."""
+
+    # streams are limited to about 5 minutes of audio, and dropped after about 10s without audio
+    max_session_time = 240
+    max_idle_time = 8
+
+    def __init__(self, language_code, encoding='linear16'):
+        from google.cloud import speech
+        self.speech = speech
+        self.client = speech.SpeechClient()
+        self.encoding = encoding
+        encoding_dict = {
+            'linear16': speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            'flac': speech.RecognitionConfig.AudioEncoding.FLAC,
+            'ogg_opus': speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
+        }
+        config = speech.RecognitionConfig(
+            encoding=encoding_dict[encoding],
+            sample_rate_hertz=RATE,
+            language_code=language_code,
+        )
+        self.streaming_config = speech.StreamingRecognitionConfig(
+            config=config, interim_results=True
+        )
+
+    def streaming_recognize(self, audio_generator, on_sent=None):
+        if self.encoding != 'linear16':
+            # one encoder per stream, every stream starts with its own header
+            audio_generator = self._encode_generator(audio_generator)
+
+        requests = (
+            self.speech.StreamingRecognizeRequest(audio_content=content)
+            for content in self._sent_generator(audio_generator, on_sent)
+        )
+
+        responses = self.client.streaming_recognize(self.streaming_config, requests)
+
+        for response in responses:
+            if not response.results:
+                continue
+
+            # The `results` list is consecutive. For streaming, we only care about
+            # the first result being considered, since once it's `is_final`, it
+            # moves on to considering the next utterance.
+            result = response.results[0]
+            if not result.alternatives:
+                continue
+
+            # stream time of the end of the audio the result covers
+            audio_end = result.result_end_time.total_seconds()
+            if result.is_final:
+                yield SttResult(result.alternatives[0].transcript, True, result.stability, audio_end=audio_end)
+                continue
+
+            # an interim response is a stable head followed by less stable tails
+            segment_list = [(r.alternatives[0].transcript, r.stability) for r in response.results if r.alternatives]
+            transcript = ''.join(t for t, _ in segment_list)
+            yield SttResult(transcript, False, result.stability, segment_list, audio_end)
+
+    def _encode_generator(self, audio_generator):
+        encoder = audio_encoder.StreamEncoder(self.encoding)
+        for content in audio_generator:
+            data = encoder.encode(content)
+            if len(data) > 0:
+                yield data
+        data = encoder.flush()
+        if len(data) > 0:
+            yield data
+
+    def _sent_generator(self, audio_generator, on_sent):
+        for content in audio_generator:
+            content = bytes(content)
+            if on_sent is not None:
+                on_sent(len(content))
+            yield content
+
+
+class VoskSttBackend(object):
+    """Offline recognizer running a Vosk (Kaldi) model in-process on the CPU.
+
+    The language is defined by the model, language_code is not used.
+    """
+
+    max_session_time = None
+    max_idle_time = None
+
+    def __init__(self, model_path):
+        import vosk
+        self.vosk = vosk
+        self.model = vosk.Model(model_path)
+
+    def streaming_recognize(self, audio_generator, on_sent=None):
+        # in-process, nothing goes over the wire
+        recognizer = self.vosk.KaldiRecognizer(self.model, RATE)
+
+        last_transcript = None
+        last_is_final = True
+        audio_time = 0.0
+        for content in audio_generator:
+            audio_time += len(content) / SAMPLE_WIDTH / RATE
+            if recognizer.AcceptWaveform(bytes(content)):
+                transcript = json.loads(recognizer.Result())['text']
+                is_final = True
+            else:
+                transcript = json.loads(recognizer.PartialResult())['partial']
+                is_final = False
+            if transcript == last_transcript and is_final == last_is_final:
+                continue
+            if is_final and len(transcript) <= 0:
+                continue
+            last_transcript = transcript
+            last_is_final = is_final
+            yield SttResult(transcript, is_final, 1.0 if is_final else 0.0, audio_end=audio_time)
+
+        transcript = json.loads(recognizer.FinalResult())['text']
+        if len(transcript) > 0 or not last_is_final:
+            yield SttResult(transcript, True, 1.0, audio_end=audio_time)
+
+
+class FakeSttBackend(object):
+    """Local stand-in for a streaming recognizer, for benchmarks and runs without a provider.
+
+    Each request is answered by an interim result latency seconds after it was read, and the
+    end of the stream by a final one. The transcript is the length of the audio received.
+    """
+
+    max_session_time = None
+    max_idle_time = None
+
+    def __init__(self, latency=0.3):
+        self.latency = latency
+
+    def streaming_recognize(self, audio_generator, on_sent=None):
+        # requests are read in their own thread, like a real stream, so the latency does not throttle them
+        result_queue = queue.Queue() # (due time, result), None at the end
+        thread = threading.Thread(target=self._read, args=(audio_generator, on_sent, result_queue), name='FakeSttBackend')
+        thread.start()
+        while True:
+            item = result_queue.get()
+            if item is None: break
+            due_time, result = item
+            delay = due_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            yield result
+        thread.join()
+
+    def _read(self, audio_generator, on_sent, result_queue):
+        try:
+            audio_time = 0.0
+            for content in audio_generator:
+                if on_sent is not None:
+                    on_sent(len(content))
+                audio_time += len(content) / SAMPLE_WIDTH / RATE
+                result_queue.put((time.time() + self.latency, SttResult('speech {:.1f}s'.format(audio_time), False, 0.9, audio_end=audio_time)))
+            if audio_time > 0:
+                result_queue.put((time.time() + self.latency, SttResult('speech {:.1f}s'.format(audio_time), True, 1.0, audio_end=audio_time)))
+        except:
+            traceback.print_exc()
+        finally:
+            result_queue.put(None)
+
+
+def create_stt_backend(init_args, language_code=None):
+    # language_code: one entry of init_args.language_code, default the first
+    language_code_list = init_args.language_code.split(',')
+    if language_code is None:
+        language_code = language_code_list[0]
+    if init_args.stt == 'google':
+        return GoogleSttBackend(language_code, init_args.stt_encoding)
+    if init_args.stt == 'vosk':
+        stt_model_list = init_args.stt_model.split(',')
+        if len(stt_model_list) == 1:
+            return VoskSttBackend(stt_model_list[0])
+        return VoskSttBackend(stt_model_list[language_code_list.index(language_code)])
+    if init_args.stt == 'fake':
+        return FakeSttBackend(init_args.stt_fake_latency)
+    raise ValueError('Unknown STT backend: {}'.format(init_args.stt))
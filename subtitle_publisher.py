@@ -0,0 +1,98 @@
+import threading
+import time
+import traceback
+
+class SubtitlePublisher(object):
+    """Sits between the recognizers and the room's text channels, one thread per TranslationAgent.
+
+    - interim results of a language are coalesced to one per room.subtitle_interim_interval;
+      the first one after a quiet period goes out at once, so no latency is added
+    - segments the recognizer marks as unstable (0 < stability < room.subtitle_min_stability)
+      are held back; a stability of 0 means the backend gives none
+    - an interim text equal to the last published one is not published again
+    - final results are never coalesced or dropped, stop() publishes what is still pending
+    publish(language_code, text, is_final, capture_time) is called from the publisher thread,
+    capture_time being the result's SttResult.capture_time.
+    """
+
+    def __init__(self, room, publish):
+        self.room = room
+        self.publish = publish
+        self.lock = threading.Condition()
+        self.pending_dict = {} # language_code -> [(text, is_final, capture_time)], at most one interim, last
+        self.publish_time_dict = {} # language_code -> time of the last interim publish
+        self.published_text_dict = {} # language_code -> last published text
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name='SubtitlePublisher-{}'.format(self.room.room_id))
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, language_code, result):
+        text = self._get_stable_text(result)
+        with self.lock:
+            pending_list = self.pending_dict.setdefault(language_code, [])
+            if len(pending_list) > 0 and not pending_list[-1][1]:
+                # superseded before it was published
+                pending_list.pop()
+            pending_list.append((text, result.is_final, result.capture_time))
+            self.lock.notify()
+
+    def run(self):
+        running = True
+        while running:
+            with self.lock:
+                while True:
+                    running = self.running
+                    publish_list, wait_time = self._take_due(time.time(), flush=not running)
+                    if len(publish_list) > 0 or not running: break
+                    self.lock.wait(timeout=wait_time)
+            for language_code, text, is_final, capture_time in publish_list:
+                # a failing publish (e.g. translation backend down) loses that item only
+                try:
+                    self.publish(language_code, text, is_final, capture_time)
+                except:
+                    traceback.print_exc()
+
+    def _take_due(self, now, flush=False):
+        # caller holds lock, flush takes everything pending
+        interval = self.room.subtitle_interim_interval
+        publish_list = []
+        wait_time = None
+        for language_code, pending_list in self.pending_dict.items():
+            while len(pending_list) > 0:
+                text, is_final, capture_time = pending_list[0]
+                if not is_final:
+                    if text == self.published_text_dict.get(language_code, None):
+                        pending_list.pop(0)
+                        continue
+                    due_time = self.publish_time_dict.get(language_code, 0) + interval
+                    if due_time > now and not flush:
+                        wait_time = due_time - now if wait_time is None else min(wait_time, due_time - now)
+                        break
+                    self.publish_time_dict[language_code] = now
+                pending_list.pop(0)
+                self.published_text_dict[language_code] = text
+                publish_list.append((language_code, text, is_final, capture_time))
+        return publish_list, wait_time
+
+    def _get_stable_text(self, result):
+        if result.is_final:
+            return result.transcript
+        min_stability = self.room.subtitle_min_stability
+        text = ''
+        for transcript, stability in result.segment_list:
+            if 0 < stability < min_stability: break
+            text += transcript
+        return text
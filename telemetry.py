@@ -0,0 +1,62 @@
+import collections
+import lock_stat
+import struct
+import time
+
+VOL_HISTORY_SIZE = 100 # 10s of 100ms samples
+VOL_INTERVAL = 100 # ms between samples, smaller capture frames are folded into one
+
+# /vol response: header (last seq, sample count), then per sample (time, vol), little endian
+PACK_HEADER = struct.Struct('<II')
+PACK_SAMPLE = struct.Struct('<dI')
+
+class VolTelemetry(object):
+    """Recent volume samples, kept out of the status dict so the meter does not churn /status.
+
+    Subscribers (anything with put()) get each new seq, as room text and status subscribers do.
+    """
+
+    def __init__(self, capacity=VOL_HISTORY_SIZE, name='telemetry'):
+        self.lock = lock_stat.MeasuredCondition(name)
+        self.seq = 0
+        self.sample_deque = collections.deque(maxlen=capacity) # (seq, time, vol)
+        self.subscriber_set = set()
+
+    def push(self, sample_time, vol):
+        with self.lock:
+            self.seq += 1
+            self.sample_deque.append((self.seq, sample_time, vol))
+            for subscriber in self.subscriber_set:
+                subscriber.put(self.seq)
+            self.lock.notify_all()
+
+    def subscribe(self, subscriber):
+        with self.lock:
+            self.subscriber_set.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscriber_set.discard(subscriber)
+
+    def get_since(self, since, timeout):
+        with self.lock:
+            if since > self.seq:
+                since = 0 # client is ahead of us, e.g. after a server restart
+            timeout = time.time() + timeout
+            while self.seq == since:
+                now = time.time()
+                if now >= timeout: break
+                self.lock.wait(timeout=timeout-now)
+            seq = self.seq
+            sample_list = [sample for sample in self.sample_deque if sample[0] > since]
+        return seq, sample_list
+
+    def get_packed_since(self, since, timeout):
+        seq, sample_list = self.get_since(since, timeout)
+        buf = bytearray(PACK_HEADER.size + PACK_SAMPLE.size * len(sample_list))
+        PACK_HEADER.pack_into(buf, 0, seq, len(sample_list))
+        offset = PACK_HEADER.size
+        for _, sample_time, vol in sample_list:
+            PACK_SAMPLE.pack_into(buf, offset, sample_time, vol)
+            offset += PACK_SAMPLE.size
+        return bytes(buf)
@@ -0,0 +1,97 @@
+from collections import deque
+import json
+import os
+import threading
+import time
+
+TRACE_BUFFER_SIZE = 200000 # spans kept, oldest dropped first
+
+class Tracer(object):
+    """Opt-in span recorder for the audio and subtitle pipeline, dumped as a Chrome trace.
+
+    Spans go into a bounded deque; append is atomic, so recording takes no lock. While the
+    tracer is disabled, span() returns a shared no-op and generators are not wrapped at all.
+    Open the dump in chrome://tracing or ui.perfetto.dev.
+    """
+
+    def __init__(self, capacity=TRACE_BUFFER_SIZE):
+        self.enabled = False
+        self.span_deque = deque(maxlen=capacity) # (name, start, end, thread)
+
+    def set_enabled(self, enabled):
+        if enabled and not self.enabled:
+            self.span_deque.clear()
+        self.enabled = enabled
+
+    def add(self, name, start, end):
+        # start / end from time.perf_counter()
+        self.span_deque.append((name, start, end, threading.current_thread()))
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def trace_generator(self, name, generator):
+        # one span per item, the time it took to produce; upstream stages nest inside it
+        if not self.enabled:
+            return generator
+        return self._trace_generator(name, generator)
+
+    def _trace_generator(self, name, generator):
+        iterator = iter(generator)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, start, time.perf_counter())
+                return
+            self.add(name, start, time.perf_counter())
+            yield item
+
+    def dump(self):
+        # Chrome trace event format, complete ("X") events in microseconds
+        pid = os.getpid()
+        event_list = []
+        tid_dict = {} # thread -> tid in the trace, thread idents are reused once a thread ends
+        for name, start, end, thread in list(self.span_deque):
+            tid = tid_dict.get(thread, None)
+            if tid is None:
+                tid = len(tid_dict) + 1
+                tid_dict[thread] = tid
+                event_list.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid, 'args': {'name': thread.name}})
+            event_list.append({
+                'ph': 'X', 'name': name, 'pid': pid, 'tid': tid,
+                'ts': start * 1000000, 'dur': (end - start) * 1000000,
+            })
+        return json.dumps({'traceEvents': event_list, 'displayTimeUnit': 'ms'})
+
+
+class _Span(object):
+
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.tracer.add(self.name, self.start, time.perf_counter())
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+TRACER = Tracer()
@@ -0,0 +1,87 @@
+from six.moves import queue
+import sqlite3
+import threading
+import traceback
+
+MAX_QUERY_LIMIT = 1000
+
+class TranscriptHistory(object):
+    """Finalized utterances of every room and language, in an SQLite file.
+
+    Rows are appended by a background thread, a batch per commit, so the STT threads never
+    wait on the disk. seq is the rowid and (room_id, language_code, seq) is indexed, so
+    query() reads only the rows it returns however long the event runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock() # one connection, shared by the writer and the web server
+        self.write_queue = queue.Queue()
+        self.thread = None
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS transcript ('
+                'seq INTEGER PRIMARY KEY, time REAL, room_id TEXT, language_code TEXT, text TEXT)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS transcript_room_language_seq '
+                'ON transcript (room_id, language_code, seq)'
+            )
+            self.connection.commit()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.write_queue.put(None)
+        self.thread.join()
+        self.thread = None
+        with self.lock:
+            self.connection.close()
+
+    def submit(self, time, room_id, language_code, text):
+        self.write_queue.put((time, room_id, language_code, text))
+
+    def run(self):
+        running = True
+        while running:
+            item_list = [self.write_queue.get()]
+            # take whatever else is queued, one commit for the lot
+            while True:
+                try:
+                    item_list.append(self.write_queue.get(block=False))
+                except queue.Empty:
+                    break
+            if None in item_list:
+                running = False
+                item_list = [item for item in item_list if item is not None]
+            if len(item_list) <= 0:
+                continue
+            try:
+                with self.lock:
+                    self.connection.executemany(
+                        'INSERT INTO transcript (time, room_id, language_code, text) VALUES (?, ?, ?, ?)',
+                        item_list,
+                    )
+                    self.connection.commit()
+            except:
+                traceback.print_exc()
+
+    def query(self, room_id, language_code, since, limit):
+        # entries with seq > since, oldest first
+        limit = max(0, min(limit, MAX_QUERY_LIMIT))
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT seq, time, text FROM transcript '
+                'WHERE room_id = ? AND language_code = ? AND seq > ? ORDER BY seq LIMIT ?',
+                (room_id, language_code, since, limit),
+            )
+            row_list = cursor.fetchall()
+        return [{'seq': seq, 'time': time, 'text': text} for seq, time, text in row_list]
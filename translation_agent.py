@@ -1,25 +1,46 @@
+import audio_format
+import audio_queue
 from collections import deque
+import metrics
+import pcm_ring_buffer
 import threading
 import traceback
 import pyaudio
-from six.moves import queue
-from google.cloud import speech
+import stt_backend
+import subtitle_publisher
 import time
-import numpy as np
+import tracing
 
-RATE = 16000
-CHUNK = int(RATE / 10)  # 100ms
+RATE = audio_format.RATE
+SAMPLE_WIDTH = audio_format.SAMPLE_WIDTH
+PCM_BUFFER_TIME = 60 # seconds of audio kept in the ring buffer
+JOIN_BACKLOG_TIME = 5 # seconds of segmented audio JoinDataGenerator reads ahead of the STT streams
 
 class TranslationAgent:
 
-    def __init__(self, runtime):
-        self.runtime = runtime
-        self.init_args = runtime.init_args
-        self.main_lock = runtime.main_lock
-
-        self.audio_buffer = queue.Queue()
+    def __init__(self, room):
+        self.room = room
+        self.runtime = room.runtime
+        self.init_args = room.init_args
+        self.main_lock = room.main_lock
+
+        # audio is stored once in pcm_buffer, audio_buffer only carries the AudioFrame metadata
+        self.pcm_buffer = pcm_ring_buffer.PcmRingBuffer(RATE * PCM_BUFFER_TIME)
+        # bounded so a stalled recognizer cannot build an ever growing backlog,
+        # and well inside pcm_buffer so queued frames are never overwritten
+        self.audio_buffer = audio_queue.AudioQueue(room, PCM_BUFFER_TIME * RATE // 2)
+        self.audio_drop_count = 0
+        self.audio_late_count = 0
         # self.audio_buffer = None
-        self.preactive_buffer = deque()
+
+        # one recognizer per language, all fed from the same captured and segmented audio
+        self.language_code_list = room.language_code_list
+        self.stt_backend_dict = {} # language_code -> backend
+        self.prewarm_session_dict = {} # language_code -> session opened during silence, used by the next utterance
+        self.utterance_start_time = None
+        self.speech_onset_time = None # capture time of the frame that triggered the utterance
+        self.last_frame_time = None # capture time of the newest frame taken from audio_buffer
+        self.subtitle_publisher = subtitle_publisher.SubtitlePublisher(room, self._publish_text)
 
         self.enabled = False
         # self.state = None
@@ -34,7 +55,7 @@ class TranslationAgent:
             self.enabled = True
             if self.thread is not None:
                 return
-            self.thread = threading.Thread(target=self.run)
+            self.thread = threading.Thread(target=self.run, name='TranslationAgent-{}'.format(self.room.room_id))
             self.thread.start()
         print('TranslationAgent started')
 
@@ -70,20 +91,16 @@ class TranslationAgent:
 
     def run(self):
         try:
-            client = speech.SpeechClient()
-            config = speech.RecognitionConfig(
-                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-                sample_rate_hertz=RATE,
-                language_code=self.init_args.language_code,
-            )
+            self.subtitle_publisher.start()
 
-            streaming_config = speech.StreamingRecognitionConfig(
-                config=config, interim_results=True
-            )
+            for language_code in self.language_code_list:
+                self.stt_backend_dict[language_code] = stt_backend.create_stt_backend(self.init_args, language_code)
 
             while self.is_running():
                 print('Listening...')
-                self.runtime.update_status('api_state', 'WAIT')
+                self.room.update_status('api_state', 'WAIT')
+
+                self._prewarm_session()
 
                 audio_generator = self.audio_generator()
 
@@ -91,45 +108,14 @@ class TranslationAgent:
                     break
 
                 print('Processing...')
-                self.runtime.update_status('api_state', 'ACTIVE')
-
-                requests = (
-                    speech.StreamingRecognizeRequest(audio_content=content)
-                    for content in audio_generator
-                )
-
-                responses = client.streaming_recognize(streaming_config, requests)
-
-                for response in responses:
-
-                    if not self.is_running():
-                        break
-
-                    if not response.results:
-                        continue
-
-                    result = response.results[0]
-                    if not result.alternatives:
-                        continue
+                self.room.update_status('api_state', 'ACTIVE')
 
-                    transcript = result.alternatives[0].transcript
-
-                    print(transcript)
-
-                    self.runtime.update_text(transcript)
-
-                    # with self.main_lock:
-                    #     if result.is_final:
-                    #         self.state = 'FINISHED'
-                    #         self.state_time = time.time()
-                    #     elif self.state == 'PROCESS_EMPTY' and len(transcript) > 0:
-                    #         self.state = 'PROCESS_BUSY'
-                    #         self.state_time = time.time()
+                self._process_utterance(audio_generator)
 
                 print('Finished listening')
-                self.runtime.update_status('api_state', 'END')
+                self.room.update_status('api_state', 'END')
 
-            self.runtime.update_status('api_state', 'OFF')
+            self.room.update_status('api_state', 'OFF')
 
             print('HEOULTFDFB SpeechToText thread finished')
         except:
@@ -137,94 +123,241 @@ class TranslationAgent:
             with self.main_lock:
                 self.runtime.running = False
                 self.main_lock.notify()
+        finally:
+            for session in self.prewarm_session_dict.values():
+                session.close()
+            self.prewarm_session_dict = {}
+            self.subtitle_publisher.stop()
 
         print('NTZALJQJYF')
 
-    def on_audio_listener_data(self, in_data):
-        self.audio_buffer.put(in_data)
+    def _process_utterance(self, audio_generator):
+        # the utterance is segmented once and sent to every language's session
+        session_dict = {language_code: self._take_session(language_code) for language_code in self.language_code_list}
+        first_session = session_dict[self.language_code_list[0]]
+        session_list = list(session_dict.items()) # (language_code, session), rollover sessions appended
+        metrics.UTTERANCE_COUNT.inc(self.room.room_id)
+
+        # recently sent audio, replayed into the next session on rollover
+        overlap_deque = deque()
+        overlap_time = 0.0
+
+        # copied out of pcm_buffer for the sample storage, off the capture thread
+        sample_storage = self.room.sample_storage
+        sample_data = bytearray() if sample_storage is not None else None
+        utterance_start_time = self.utterance_start_time
+
+        try:
+            for content, capture_time in audio_generator:
+                # out of pcm_buffer once, queued streams may hold it for a while
+                content = bytes(content)
+                if sample_data is not None:
+                    sample_data += content
+
+                for language_code, session in session_dict.items():
+                    if session.is_expiring():
+                        print('Rollover STT session: {}'.format(language_code))
+                        session.close()
+                        session = self._open_session(language_code, session)
+                        session_dict[language_code] = session
+                        session_list.append((language_code, session))
+                        for c, t in overlap_deque:
+                            session.send(c, t)
+                            self.room.update_stat(len(c))
+
+                    session.send(content, capture_time)
+                    self.room.update_stat(len(content))
+
+                overlap_deque.append((content, capture_time))
+                overlap_time += len(content) / SAMPLE_WIDTH / RATE
+                # an overlap time of 0 (or less) keeps nothing, there is no replay
+                while len(overlap_deque) > 0 and overlap_time - len(overlap_deque[0][0]) / SAMPLE_WIDTH / RATE >= self.room.stt_rollover_overlap_time:
+                    overlap_time -= len(overlap_deque.popleft()[0]) / SAMPLE_WIDTH / RATE
+        finally:
+            # also when the utterance failed, an open stream would wait for audio forever
+            for session in session_dict.values():
+                session.close()
+
+        # open the next streams while these ones finish
+        self._prewarm_session()
+
+        for language_code, s in session_list:
+            s.join()
+            if s.first_audio_time is not None and s.first_result_time is not None:
+                metrics.REQUEST_TO_FIRST_RESULT.observe(s.first_result_time - s.first_audio_time, self.room.room_id, language_code)
+        # every stream of the utterance is done uploading
+        self.room.flush_stat()
+
+        if sample_data is not None and len(sample_data) > 0:
+            # the default language's transcript, sessions of one language are in rollover order
+            transcript = ' '.join(t for language_code, s in session_list if language_code == self.language_code_list[0] for t in s.final_transcript_list)
+            sample_storage.submit(utterance_start_time, bytes(sample_data), transcript)
+
+        if first_session.first_audio_time is not None:
+            if not self.room.virtual_clock:
+                metrics.SPEECH_ONSET_TO_FIRST_REQUEST.observe(first_session.first_audio_time - self.speech_onset_time, self.room.room_id)
+            status_dict = {
+                # how long the stream was open before audio arrived, 0 when it was opened on demand
+                'stt_prewarm_time': first_session.first_audio_time - first_session.open_time,
+            }
+            if first_session.first_result_time is not None:
+                status_dict['stt_first_result_latency'] = first_session.first_result_time - first_session.first_audio_time
+            self.room.update_status_dict(status_dict)
+
+    def _open_session(self, language_code, previous_session=None):
+        metrics.STT_STREAM_OPEN_COUNT.inc(self.room.room_id, language_code)
+        on_result = lambda session, result: self._on_stt_result(language_code, result)
+        return stt_backend.SttSession(self.stt_backend_dict[language_code], on_result, self.room.update_wire_stat, self.is_running, previous_session)
+
+    def _prewarm_session(self):
+        if not self.room.stt_prewarm:
+            return
+        for language_code in self.language_code_list:
+            session = self.prewarm_session_dict.get(language_code, None)
+            if session is not None:
+                if session.is_usable():
+                    continue
+                session.close()
+            self.prewarm_session_dict[language_code] = self._open_session(language_code)
+
+    def _take_session(self, language_code):
+        session = self.prewarm_session_dict.pop(language_code, None)
+        if session is not None and session.is_usable():
+            return session
+        if session is not None:
+            session.close()
+        return self._open_session(language_code)
+
+    def _on_stt_result(self, language_code, result):
+        if not self.is_running():
+            return
+
+        print('{}: {}'.format(language_code, result.transcript))
+
+        self.subtitle_publisher.submit(language_code, result)
+
+    def _publish_text(self, language_code, transcript, is_final, capture_time):
+        # from the subtitle publisher thread, after coalescing and stability filtering
+        # capture_time dates the last audio the text covers, None when the backend cannot tell;
+        # frame times are synthetic under the virtual clock
+        if self.room.virtual_clock:
+            capture_time = None
+        self.room.update_text(transcript, language_code, is_final)
+        if capture_time is not None:
+            metrics.MIC_TO_TEXT.observe(time.time() - capture_time, self.room.room_id, language_code)
+
+        translator = self.runtime.translator
+        if translator is not None and language_code == translator.source_language_code:
+            for target_language_code in translator.target_language_code_list:
+                self.room.update_text(translator.translate(transcript, target_language_code, is_final, self.room.room_id), target_language_code, is_final)
+                if capture_time is not None:
+                    metrics.MIC_TO_TEXT.observe(time.time() - capture_time, self.room.room_id, target_language_code)
+
+    def on_audio_listener_data(self, frame):
+        span = self.pcm_buffer.write(frame.data)
+        frame.start = span.start
+        frame.end = span.end
+        self.audio_buffer.put(frame)
 
     def on_audio_listener_stopped(self):
         self.audio_buffer.put(None)
 
 
     def audio_generator(self):
-        ret = self._audio_buffer_generator()
-        ret = self._push_preactive_buffer(ret)
-        ret = self._noise_filter_generator(ret)
-        ret = self._wait_generator(ret)
-        ret = self._join_data_generator(ret)
-        ret = self._stat_generator(ret)
+        # stages are wrapped in spans when tracing is on as the utterance starts
+        tracer = tracing.TRACER
+        ret = tracer.trace_generator('audio_buffer', self._audio_buffer_generator())
+        ret = tracer.trace_generator('noise_filter', self._noise_filter_generator(ret))
+        ret = tracer.trace_generator('wait', self._wait_generator(ret))
+        ret = tracer.trace_generator('join_data', self._join_data_generator(ret))
         return ret
 
 
     def _audio_buffer_generator(self):
         while self.is_running():
             content = self.audio_buffer.get()
+            self._update_audio_buffer_stat()
             if content is None: break
+            self.last_frame_time = content.time
             yield content
 
-
-    def _push_preactive_buffer(self, generator):
-        for content in generator:
-            yield content
-            self.preactive_buffer.append(content)
-            if len(self.preactive_buffer) > self.runtime.thereshold_off_on_time:
-                self.preactive_buffer.popleft()
+    def _update_audio_buffer_stat(self):
+        # published from the consumer side, so the capture thread never touches status
+        drop_count = self.audio_buffer.drop_count
+        late_count = self.audio_buffer.late_count
+        if drop_count == self.audio_drop_count and late_count == self.audio_late_count:
+            return
+        self.audio_drop_count = drop_count
+        self.audio_late_count = late_count
+        self.room.update_status_dict({
+            'audio_dropped': drop_count,
+            'audio_late': late_count,
+        })
 
 
     def _noise_filter_generator(self, generator):
-        self.runtime.update_status('vol_state', 'WAIT')
+        self.room.update_status('vol_state', 'WAIT')
 
         # wait noise cotent
         content = None
         for c in generator:
-            c_np = np.frombuffer(c, dtype=np.int16)
-            c_np = c_np.astype(np.int32)
-            c_diff = c_np.max() - c_np.min()
-            if c_diff >= self.runtime.thereshold_off_on_vol:
+            if c.ptp >= self.room.thereshold_off_on_vol:
                 content = c
                 break
+            # replace the prewarmed stream before the provider drops it for idling
+            self._prewarm_session()
 
         if content is None:
-            self.runtime.update_status('vol_state', 'END')
+            self.room.update_status('vol_state', 'END')
             return
 
         if not self.is_running():
-            self.runtime.update_status('vol_state', 'END')
+            self.room.update_status('vol_state', 'END')
             return
 
-        self.runtime.update_status('vol_state', 'PREACTIVE')
+        self.room.update_status('vol_state', 'PREACTIVE')
 
-        for c in self.preactive_buffer:
-            yield c
+        # the audio just before the trigger is still in pcm_buffer
+        preactive_start = content.start - audio_format.ms_to_samples(self.room.thereshold_off_on_time)
+        preactive_start = max(preactive_start, self.pcm_buffer.get_start())
+        self.utterance_start_time = content.time - (content.start - preactive_start) / RATE
+        self.speech_onset_time = content.time
+        if preactive_start < content.start:
+            yield pcm_ring_buffer.PcmSpan(preactive_start, content.start)
         yield content
 
-        self.runtime.update_status('vol_state', 'ACTIVE')
+        self.room.update_status('vol_state', 'ACTIVE')
 
-        # wait silence
-        silence_buffer = deque()
-        silence_count = 0
+        # wait silence, held back silence is just a span of pcm_buffer
+        # silence is measured in samples, so the ms thresholds hold for any frame size
+        # vol_state is only published on a change, frames can come 100 a second
+        silence_start = None
+        silence_sample_count = 0
+        vol_state = 'ACTIVE'
         for content in generator:
-            content_np = np.frombuffer(content, dtype=np.int16)
-            content_np = content_np.astype(np.int32)
-            context_diff = content_np.max() - content_np.min()
-            if context_diff < self.runtime.thereshold_on_off_vol:
-                silence_count += 1
+            if content.ptp < self.room.thereshold_on_off_vol:
+                silence_sample_count += content.end - content.start
             else:
-                silence_count = 0
-
-            if silence_count < self.runtime.thereshold_on_pause_time:
-                self.runtime.update_status('vol_state', 'ACTIVE')
-                while len(silence_buffer) > 0:
-                    yield silence_buffer.popleft()
+                silence_sample_count = 0
+
+            if silence_sample_count < audio_format.ms_to_samples(self.room.thereshold_on_pause_time):
+                if vol_state != 'ACTIVE':
+                    vol_state = 'ACTIVE'
+                    self.room.update_status('vol_state', vol_state)
+                if silence_start is not None:
+                    yield pcm_ring_buffer.PcmSpan(silence_start, content.start)
+                    silence_start = None
                 yield content
-            elif silence_count < self.runtime.thereshold_on_off_time:
-                self.runtime.update_status('vol_state', 'SILENCE')
-                silence_buffer.append(content)
+            elif silence_sample_count < audio_format.ms_to_samples(self.room.thereshold_on_off_time):
+                if vol_state != 'SILENCE':
+                    vol_state = 'SILENCE'
+                    self.room.update_status('vol_state', vol_state)
+                if silence_start is None:
+                    silence_start = content.start
             else:
                 break
         
-        self.runtime.update_status('vol_state', 'END')
+        self.room.update_status('vol_state', 'END')
 
 
     def _wait_generator(self, generator):
@@ -245,25 +378,30 @@ class TranslationAgent:
             yield c
 
     def _join_data_generator(self, generator):
-        ret = JoinDataGenerator(generator)
+        ret = JoinDataGenerator(generator, self.pcm_buffer)
         return ret
 
-    def _stat_generator(self, generator):
-        for content in generator:
-            self.runtime.update_stat(len(content))
-            yield content
-
     def is_running(self):
         return self.runtime.running and self.enabled
 
 
 class JoinDataGenerator:
+    """Reads the segmented spans in its own thread and hands them out merged, as views of pcm_buffer.
+
+    Each view comes with the capture time of its last sample, dated by the last AudioFrame of
+    its run of spans, None for a run of PcmSpans only.
 
-    def __init__(self, generator):
+    The reader stays at most JOIN_BACKLOG_TIME ahead of the consumer, so a slow consumer backs up
+    into the AudioQueue instead of letting queued spans age out of pcm_buffer.
+    """
+
+    def __init__(self, generator, pcm_buffer):
         self.generator = generator
+        self.pcm_buffer = pcm_buffer
         self.lock = threading.Condition()
         self.content_queue = deque()
-        self.thread = threading.Thread(target=self.run)
+        self.sample_count = 0 # samples in content_queue
+        self.thread = threading.Thread(target=self.run, name='JoinDataGenerator')
         self.thread.start()
 
     def __iter__(self):
@@ -274,18 +412,48 @@ class JoinDataGenerator:
                     self.lock.wait()
                 content_list = list(self.content_queue)
                 self.content_queue.clear()
+                self.sample_count = 0
+                self.lock.notify()
             if content_list[-1] is None:
                 content_list = content_list[:-1]
                 running = False
-            ret = b''.join(content_list)
-            # print(len(ret))
-            yield ret
+            # spans are normally back to back, merge them and hand out views of pcm_buffer
+            start = None
+            end = None
+            frame = None
+            for span in content_list:
+                if span.start != end:
+                    if start is not None:
+                        yield from self._view_list(start, end, frame)
+                    start = span.start
+                    frame = None
+                end = span.end
+                if hasattr(span, 'time'):
+                    frame = span
+            if start is not None:
+                yield from self._view_list(start, end, frame)
+
+    def _view_list(self, start, end, frame):
+        # whatever was overwritten is lost, the backlog bounds should keep that from happening
+        if start < self.pcm_buffer.get_start():
+            print('JoinDataGenerator: {} samples overwritten before they were sent'.format(self.pcm_buffer.get_start() - start))
+            start = min(self.pcm_buffer.get_start(), end)
+        ret = []
+        for view in self.pcm_buffer.view_list(start, end):
+            start += len(view) // SAMPLE_WIDTH
+            # frame.time is the capture time of its first sample
+            ret.append((view, None if frame is None else frame.time + (start - 1 - frame.start) / RATE))
+        return ret
 
     def run(self):
         # print('JoinDataGenerator started')
+        max_sample_count = JOIN_BACKLOG_TIME * RATE
         for content in self.generator:
             with self.lock:
+                while self.sample_count >= max_sample_count:
+                    self.lock.wait()
                 self.content_queue.append(content)
+                self.sample_count += content.end - content.start
                 self.lock.notify()
         with self.lock:
             self.content_queue.append(None)
@@ -0,0 +1,184 @@
+import collections
+import json
+import os
+import re
+import threading
+import time
+import traceback
+
+TRANSLATION_CACHE_SIZE = 10000 # phrases
+TAIL_REFRESH_TIME = 1.0 # seconds an interim tail may keep growing on its last translation
+
+PUNCTUATION = '.!?,;。！？，、；'
+# a phrase runs up to and including its punctuation and trailing spaces
+PHRASE_RE = re.compile(r'[^.!?,;。！？，、；]+[.!?,;。！？，、；]*\s*|[.!?,;。！？，、；]+\s*')
+
+class Translator(object):
+    """Translates recognized text into each target language, phrase by phrase through a cache.
+
+    Interim results repeat and extend the same prefix many times per second. The text is split
+    into phrases at punctuation; finished phrases, and all of a final, go through the cache.
+    The unfinished tail of an interim is kept out of the cache, in a memo per stream_key and
+    target: while it only grows, its last translation is reused for TAIL_REFRESH_TIME, so an
+    unpunctuated partial costs a backend call per second instead of one per result.
+    """
+
+    def __init__(self, backend, source_language_code, target_language_code_list, cache):
+        self.backend = backend
+        self.source_language_code = source_language_code
+        self.target_language_code_list = target_language_code_list
+        self.cache = cache
+        self.tail_lock = threading.Lock()
+        self.tail_dict = {} # (stream_key, target_language_code) -> (source, translation, translate time)
+
+    def translate(self, text, target_language_code, is_final=True, stream_key=None):
+        phrase_list = PHRASE_RE.findall(text)
+        tail_key = (stream_key, target_language_code)
+        tail = None
+        if not is_final and len(phrase_list) > 0 and phrase_list[-1].strip()[-1:] not in PUNCTUATION:
+            tail = phrase_list.pop()
+        else:
+            with self.tail_lock:
+                self.tail_dict.pop(tail_key, None)
+
+        ret = []
+        for phrase in phrase_list:
+            source = phrase.strip()
+            key = (self.source_language_code, target_language_code, source)
+            translation = self.cache.get(key)
+            if translation is None:
+                translation = self.backend.translate(source, self.source_language_code, target_language_code)
+                self.cache.put(key, translation)
+            ret.append(translation)
+            if phrase[-1:].isspace():
+                ret.append(' ')
+        if tail is not None:
+            ret.append(self._translate_tail(tail.strip(), target_language_code, tail_key))
+        return ''.join(ret).strip()
+
+    def _translate_tail(self, source, target_language_code, tail_key):
+        now = time.time()
+        with self.tail_lock:
+            memo = self.tail_dict.get(tail_key, None)
+        if memo is not None and source.startswith(memo[0]) and (source == memo[0] or now - memo[2] < TAIL_REFRESH_TIME):
+            return memo[1]
+        translation = self.backend.translate(source, self.source_language_code, target_language_code)
+        with self.tail_lock:
+            self.tail_dict[tail_key] = (source, translation, now)
+        return translation
+
+
+class TranslationCache(object):
+    """LRU of (source language, target language, phrase) -> translation, shared by every room.
+
+    Loaded from path at start and written back by save(), least recently used first.
+    """
+
+    def __init__(self, path='', capacity=TRANSLATION_CACHE_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entry_dict = collections.OrderedDict() # key -> translation, least recently used first
+        self.hit_count = 0
+        self.miss_count = 0
+
+        if self.path:
+            self.load()
+
+    def get(self, key):
+        with self.lock:
+            translation = self.entry_dict.get(key, None)
+            if translation is None:
+                self.miss_count += 1
+                return None
+            self.hit_count += 1
+            self.entry_dict.move_to_end(key)
+            return translation
+
+    def put(self, key, translation):
+        with self.lock:
+            self.entry_dict[key] = translation
+            self.entry_dict.move_to_end(key)
+            while len(self.entry_dict) > self.capacity:
+                self.entry_dict.popitem(last=False)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entry_list = json.load(f)
+        except ValueError:
+            traceback.print_exc()
+            return
+        for source_language_code, target_language_code, source, translation in entry_list:
+            self.put((source_language_code, target_language_code, source), translation)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            entry_list = [list(key) + [translation] for key, translation in self.entry_dict.items()]
+        # written aside and renamed, so a crash never leaves a torn cache file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry_list, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get_stat(self):
+        return {'size': len(self.entry_dict), 'hit_count': self.hit_count, 'miss_count': self.miss_count}
+
+
+class LocalTranslatorBackend(object):
+    """Stand-in engine for testing, no network and no model.
+
+    Looks up a JSON phrase table {target_language_code: {source: translation}}, first the whole
+    phrase, then word by word (case-insensitive); anything not in the table is kept as it is.
+    """
+
+    def __init__(self, model_path=''):
+        self.phrase_table = {}
+        if model_path:
+            with open(model_path, 'r', encoding='utf-8') as f:
+                self.phrase_table = json.load(f)
+
+    def translate(self, text, source_language_code, target_language_code):
+        table = self.phrase_table.get(target_language_code, {})
+        for phrase in (text, text.lower()):
+            if phrase in table:
+                return table[phrase]
+        return ' '.join(table.get(word.lower(), word) for word in text.split())
+
+
+class GoogleTranslatorBackend(object):
+
+    def __init__(self):
+        from google.cloud import translate_v2
+        self.client = translate_v2.Client()
+
+    def translate(self, text, source_language_code, target_language_code):
+        result = self.client.translate(
+            text,
+            source_language=source_language_code.split('-')[0],
+            target_language=target_language_code,
+            format_='text',
+        )
+        return result['translatedText']
+
+
+def create_translator(init_args):
+    # None when no --translate-to is given
+    if not init_args.translate_to:
+        return None
+    if init_args.translator == 'local':
+        backend = LocalTranslatorBackend(init_args.translator_model)
+    elif init_args.translator == 'google':
+        backend = GoogleTranslatorBackend()
+    else:
+        raise ValueError('Unknown translator backend: {}'.format(init_args.translator))
+    language_code_list = init_args.language_code.split(',')
+    source_language_code = language_code_list[0]
+    # a recognized language already has its own channel fed by its recognizer
+    target_language_code_list = [c for c in init_args.translate_to.split(',') if c not in language_code_list]
+    cache = TranslationCache(init_args.translation_cache_path)
+    return Translator(backend, source_language_code, target_language_code_list, cache)
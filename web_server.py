@@ -1,32 +1,63 @@
+import asyncio
 import base64
-import copy
-import audio_listener
+import gzip
 import hashlib
-from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+import http
 import json
+import metrics
 import os
-from threading import Thread
-import time
+import threading
 import traceback
+import tracing
 from urllib.parse import parse_qs, urlparse
 
 MY_DIRNAME = os.path.dirname(os.path.abspath(__file__))
 
-class WebServer(BaseHTTPRequestHandler):
+SSE_KEEPALIVE_TIMEOUT = 15
+LONG_POLL_TIMEOUT = 1
+KEEP_ALIVE_TIMEOUT = 60 # idle seconds before a keep-alive connection is closed
+GZIP_MIN_SIZE = 256 # bytes, smaller bodies are sent as they are
+HTML_CACHE_CONTROL = 'public, max-age=300'
+
+class WebServer(object):
+    """HTTP/1.1 server with keep-alive, on one asyncio event loop in its own thread.
+
+    A viewer costs a coroutine and a socket, not a thread. The web server registers a single
+    subscriber (ChannelHub) per room channel; a change resolves that hub's future once, through
+    call_soon_threadsafe, and every long-poll or event stream waiting on it reads the current
+    state itself. Routes that block (enable / disable, config, device probing, sample files,
+    history) run in the loop's default executor.
+
+    Capacity: the loop spends about 60us per event delivered to one viewer, so one core serves
+    about 3000 concurrent /text_stream viewers at 5 text changes per second, half that at 10.
+    Idle viewers cost memory only, a few KB each.
+
+    Responses that only depend on a channel's version (/text, /status, event stream messages)
+    are rendered once per version in the channel's hub and shared by every viewer woken by
+    the change, with an ETag for If-None-Match and a gzip variant made on first demand.
+    """
 
     def __init__(self, runtime):
         self.runtime = runtime
         self.init_args = runtime.init_args
         self.main_lock = runtime.main_lock
 
-        self.html_dict = {}
+        self.html_dict = {} # page name -> SharedResponse, compressed at load
+        self.boot_id = os.urandom(4).hex() # in every ETag, versions restart with the process
+        self.hub_dict = {} # (room_id, 'text', language_code), (room_id, 'status') or (room_id, 'vol') -> ChannelHub
+        self.connection_task_set = set()
+        self.loop = None
+        self.stop_event = None
+        self.ready = threading.Event()
 
     def start(self):
-        self.thread = Thread(target=self.run)
+        self.thread = threading.Thread(target=self.run)
         self.thread.start()
 
     def stop(self):
-        self.server.shutdown()
+        self.ready.wait()
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
         self.thread.join()
 
     def run(self):
@@ -34,12 +65,67 @@ class WebServer(BaseHTTPRequestHandler):
             self.load_html_dict()
 
             print('Starting web server')
-            self.server = ThreadingHTTPServer(('',self.init_args.port), MyRequestHandler)
-            self.server.smz_web_server = self
-            self.server.serve_forever()
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.serve())
             print('Web server stopped')
         except:
             traceback.print_exc()
+        finally:
+            self.ready.set()
+
+    async def serve(self):
+        self.stop_event = asyncio.Event()
+        self.subscribe_hub_dict()
+        self.server = await asyncio.start_server(self.on_connection, '', self.init_args.port)
+        self.ready.set()
+        try:
+            await self.stop_event.wait()
+        finally:
+            self.server.close()
+            for task in list(self.connection_task_set):
+                task.cancel()
+            await asyncio.gather(*self.connection_task_set, return_exceptions=True)
+            await self.server.wait_closed()
+            self.unsubscribe_hub_dict()
+
+    async def on_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connection_task_set.add(task)
+        try:
+            handler = MyRequestHandler(self, reader, writer)
+            while await handler.handle_one_request():
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            self.connection_task_set.discard(task)
+            writer.close()
+
+    def subscribe_hub_dict(self):
+        # one subscriber per channel, whatever the number of viewers
+        for room in self.runtime.room_dict.values():
+            for language_code in room.text_channel_dict:
+                hub = ChannelHub(self.loop)
+                room.subscribe_text(language_code, hub)
+                self.hub_dict[(room.room_id, 'text', language_code)] = hub
+            hub = ChannelHub(self.loop)
+            room.subscribe_status(hub)
+            self.hub_dict[(room.room_id, 'status')] = hub
+            hub = ChannelHub(self.loop)
+            room.vol_telemetry.subscribe(hub)
+            self.hub_dict[(room.room_id, 'vol')] = hub
+
+    def unsubscribe_hub_dict(self):
+        for key, hub in self.hub_dict.items():
+            room = self.runtime.get_room(key[0])
+            if key[1] == 'text':
+                room.unsubscribe_text(hub, key[2])
+            elif key[1] == 'vol':
+                room.vol_telemetry.unsubscribe(hub)
+            else:
+                room.unsubscribe_status(hub)
 
     def load_html_dict(self):
         # with open('web.html', 'rb') as f:
@@ -47,114 +133,429 @@ class WebServer(BaseHTTPRequestHandler):
         for fn in os.listdir(MY_DIRNAME):
             if fn.endswith('.html'):
                 with open(os.path.join(MY_DIRNAME, fn), 'rb') as f:
-                    self.html_dict[fn[:-5]] = f.read()
+                    body = f.read()
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                response = SharedResponse(body, 'text/html', etag, HTML_CACHE_CONTROL)
+                response.get_gzip_body()
+                self.html_dict[fn[:-5]] = response
+
+
+class SharedResponse(object):
+    """A response rendered once and sent as it is to every client asking for the same thing."""
 
+    def __init__(self, body, content_type, etag, cache_control='no-cache'):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.cache_control = cache_control
+        self.gzip_body = None
 
-class MyRequestHandler(BaseHTTPRequestHandler):
+    def get_gzip_body(self):
+        if self.gzip_body is None:
+            self.gzip_body = gzip.compress(self.body)
+        return self.gzip_body
 
-    def do_GET(self):
+
+class ChannelHub(object):
+    """Room subscriber that wakes every event loop waiter of one channel.
+
+    put() is called by the room under its lock, from any thread. Waiters take `future` before
+    reading the state and await it afterwards, so no change is missed between the two.
+    Whatever they render from that state is kept by get_cached() until the next change.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.cache_dict = {} # key (containing the version it was rendered from) -> rendered
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self._notify)
+
+    def _notify(self):
+        self.future.set_result(None)
+        self.future = self.loop.create_future()
+        self.cache_dict = {}
+
+    def get_cached(self, key, render):
+        ret = self.cache_dict.get(key, None)
+        if ret is None:
+            ret = render()
+            self.cache_dict[key] = ret
+        return ret
+
+    async def wait(self, future, timeout):
+        # True if the channel changed, False on timeout
         try:
-            parsed_path = urlparse(self.path)
-            print(parsed_path)
-            if parsed_path.path == '/text':
-                parsed_query = parse_qs(parsed_path.query)
-                if 'last_text_md5' in parsed_query:
-                    last_text_md5 = parsed_query['last_text_md5'][0]
-                    with self.server.smz_web_server.main_lock:
-                        timeout = time.time() + 1
-                        while True:
-                            if last_text_md5 != self.server.smz_web_server.runtime.text_md5: break
-                            now = time.time()
-                            if now >= timeout: break
-                            self.server.smz_web_server.main_lock.wait(timeout=timeout-now)
-                self.send_response(200)
-                self.send_header('Content-type', 'text/json')
-                self.end_headers()
-                with self.server.smz_web_server.main_lock:
-                    text = self.server.smz_web_server.runtime.text
-                    text_md5 = self.server.smz_web_server.runtime.text_md5
-                data = {'text': text, 'text_md5': text_md5}
-                self.wfile.write(bytes(json.dumps(data), "utf-8"))
-            elif parsed_path.path == '/status':
-                parsed_query = parse_qs(parsed_path.query)
-                if 'last_status_hash' in parsed_query:
-                    last_status_hash = parsed_query['last_status_hash'][0]
-                    with self.server.smz_web_server.main_lock:
-                        timeout = time.time() + 1
-                        while True:
-                            if last_status_hash != self.server.smz_web_server.runtime.status_hash: break
-                            now = time.time()
-                            if now >= timeout: break
-                            self.server.smz_web_server.main_lock.wait(timeout=timeout-now)
-                self.send_response(200)
-                self.send_header('Content-type', 'text/json')
-                self.end_headers()
-                with self.server.smz_web_server.main_lock:
-                    status = copy.deepcopy(self.server.smz_web_server.runtime.status)
-                    status_hash = copy.deepcopy(self.server.smz_web_server.runtime.status_hash)
-                data = {'status': status, 'status_hash': status_hash}
-                self.wfile.write(bytes(json.dumps(data), "utf-8"))
-            elif parsed_path.path == '/audio_input_device_list':
-                self.send_response(200)
-                self.send_header('Content-type', 'text/json')
-                self.end_headers()
-                audio_input_device_list = audio_listener.get_audio_input_device_list()
-                data = {'audio_input_device_list': audio_input_device_list}
-                self.wfile.write(bytes(json.dumps(data), "utf-8"))
-            elif parsed_path.path == '/set_audio_input_device':
-                parsed_query = parse_qs(parsed_path.query)
-                if not 'hash' in parsed_query:
-                    self.send_response(400)
-                    self.send_header('Content-type', 'text/plain')
-                    self.end_headers()
-                    self.wfile.write(bytes('Bad request', "utf-8"))
-                    return
-                hash = parsed_query['hash'][0]
-                self.server.smz_web_server.runtime.set_audio_input_device_hash(hash)
-                self.send_response(200)
-                self.send_header('Content-type', 'text/json')
-                self.end_headers()
-                self.wfile.write(bytes('{"result":"OK"}', "utf-8"))
-            elif parsed_path.path == '/enable':
-                self.server.smz_web_server.runtime.enable()
-                self.send_response(200)
-                self.send_header('Content-type', 'text/json')
-                self.end_headers()
-                self.wfile.write(bytes('{"result":"OK"}', "utf-8"))
-            elif parsed_path.path == '/disable':
-                self.server.smz_web_server.runtime.disable()
-                self.send_response(200)
-                self.send_header('Content-type', 'text/json')
-                self.end_headers()
-                self.wfile.write(bytes('{"result":"OK"}', "utf-8"))
-            elif parsed_path.path == '/set_config_dict':
-                parsed_query = parse_qs(parsed_path.query)
-                if not 'config' in parsed_query:
-                    self.send_response(400)
-                    self.send_header('Content-type', 'text/plain')
-                    self.end_headers()
-                    self.wfile.write(bytes('Bad request', "utf-8"))
-                    return
-                config_dict_json_b64 = parsed_query['config'][0]
-                config_dict_json = base64.b64decode(config_dict_json_b64).decode('utf-8')
-                config_dict = json.loads(config_dict_json)
-                print(config_dict)
-                self.server.smz_web_server.runtime.set_config_dict(config_dict)
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class MyRequestHandler(object):
+    """One connection, requests handled one after another while the client keeps it alive.
+
+    The response is buffered: send_response / send_header / write, then it goes out with its
+    Content-Length. Event streams call start_stream() instead and end the connection.
+    """
+
+    def __init__(self, web_server, reader, writer):
+        self.web_server = web_server
+        self.reader = reader
+        self.writer = writer
+
+    async def handle_one_request(self):
+        # False when the connection is to be closed
+        try:
+            request_line = await asyncio.wait_for(self.reader.readline(), KEEP_ALIVE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        if not request_line:
+            return False
+        self.header_dict = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''): break
+            name, _, value = line.decode('latin-1').partition(':')
+            self.header_dict[name.strip().lower()] = value.strip()
+
+        self.status = None
+        self.header_list = []
+        self.body_list = []
+        self.streaming = False
+        self.route = 'other' # metrics label, known routes only
+        try:
+            self.command, self.path, self.request_version = request_line.decode('latin-1').split()
+        except ValueError:
+            self.keep_alive = False
+            self.send_error(400, 'Bad request')
+            await self.finish()
+            return False
+
+        connection = self.header_dict.get('connection', '').lower()
+        if self.request_version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+        content_length = int(self.header_dict.get('content-length', '0'))
+        if content_length > 0:
+            await self.reader.readexactly(content_length)
+
+        if self.command == 'GET':
+            try:
+                await self.do_GET()
+            except (ConnectionError, asyncio.CancelledError):
+                raise
+            except:
+                traceback.print_exc()
+                self.keep_alive = False
+                if self.status is None:
+                    self.send_error(500, 'Internal server error')
+        else:
+            self.send_error(501, 'Unsupported method')
+        if self.streaming:
+            return False
+        await self.finish()
+        return self.keep_alive
+
+    async def do_GET(self):
+        parsed_path = urlparse(self.path)
+        print(parsed_path)
+        web_server = self.web_server
+        runtime = web_server.runtime
+        loop = asyncio.get_running_loop()
+        # /room/<room_id>/<route> addresses one room, a bare /<route> the default room
+        path = parsed_path.path
+        room = runtime.get_room()
+        if path.startswith('/room/'):
+            room_id, _, path = path[len('/room/'):].partition('/')
+            path = '/' + path
+            room = runtime.get_room(room_id)
+            if room is None:
+                self.send_error(404, 'Room not found')
+                return
+        self.route = path
+        parsed_query = parse_qs(parsed_path.query)
+        if path in ('/text', '/text_stream', '/history'):
+            # ?lang=<language code> picks one of the room's subtitle channels, default the first
+            language_code = parsed_query['lang'][0] if 'lang' in parsed_query else None
+            text_channel = room.get_text_channel(language_code)
+            if text_channel is None:
+                self.send_error(404, 'Language not found')
+                return
+            hub = web_server.hub_dict[(room.room_id, 'text', text_channel.language_code)]
+        if path == '/text':
+            if 'since' in parsed_query:
+                since = self.parse_query(parsed_query, 'since', int)
+                if since is None: return
+                timeout = loop.time() + LONG_POLL_TIMEOUT
+                while since == text_channel.text_version:
+                    now = loop.time()
+                    if now >= timeout: break
+                    if not await hub.wait(hub.future, timeout-now): break
+                    metrics.LONG_POLL_WAKEUP_COUNT.inc('/text')
+            with room.text_lock:
+                text = text_channel.text
+                text_version = text_channel.text_version
+            data = {'text': text, 'text_version': text_version, 'lang': text_channel.language_code}
+            self.send_shared(hub.get_cached(('text', text_version), lambda: self.make_json_response(data, text_version)))
+        elif path == '/history':
+            # finalized subtitles after seq `since`, oldest first, at most `limit` of them
+            history = runtime.transcript_history
+            if history is None:
+                self.send_error(400, 'Bad request')
+                return
+            since = self.parse_query(parsed_query, 'since', int, 0)
+            if since is None: return
+            limit = self.parse_query(parsed_query, 'limit', int, 100)
+            if limit is None: return
+            entry_list = await loop.run_in_executor(None, history.query, room.room_id, text_channel.language_code, since, limit)
+            data = {'history': entry_list, 'lang': text_channel.language_code}
+            self.send_json(data)
+        elif path == '/status':
+            hub = web_server.hub_dict[(room.room_id, 'status')]
+            since = 0
+            if 'since' in parsed_query:
+                since = self.parse_query(parsed_query, 'since', int)
+                if since is None: return
+                timeout = loop.time() + LONG_POLL_TIMEOUT
+                while since == room.status_version:
+                    now = loop.time()
+                    if now >= timeout: break
+                    if not await hub.wait(hub.future, timeout-now): break
+                    metrics.LONG_POLL_WAKEUP_COUNT.inc('/status')
+            with room.status_lock:
+                if since > room.status_version:
+                    since = 0 # client is ahead of us, e.g. after a server restart
+                status_version = room.status_version
+                # status values are plain json values and replaced rather than mutated, a shallow copy is enough
+                render = lambda: self.make_json_response(
+                    {'status': room.get_status_since(since), 'status_version': status_version, 'since': since},
+                    since, status_version,
+                )
+                response = hub.get_cached(('status', since, status_version), render)
+            self.send_shared(response)
+        elif path == '/text_stream':
+            last_text = None
+            def read_text(version):
+                nonlocal last_text
+                with room.text_lock:
+                    text = text_channel.text
+                    text_version = text_channel.text_version
+                if text_version == version:
+                    return version, None
+                # viewers that were at the same version share the message
+                if last_text is None:
+                    render = lambda: make_event(text)
+                else:
+                    render = lambda: make_event(diff_text(last_text, text))
+                event = hub.get_cached(('event', version, text_version), render)
+                last_text = text
+                return text_version, event
+            await self.send_event_stream(hub, read_text)
+        elif path == '/status_stream':
+            hub = web_server.hub_dict[(room.room_id, 'status')]
+            def read_status(version):
+                # the first event carries the whole status, later ones the keys changed since
+                with room.status_lock:
+                    status_version = room.status_version
+                    if status_version == version:
+                        return version, None
+                    render = lambda: make_event(room.get_status_since(version or 0))
+                    return status_version, hub.get_cached(('event', version, status_version), render)
+            await self.send_event_stream(hub, read_status)
+        elif path == '/vol':
+            since = self.parse_query(parsed_query, 'since', int, 0)
+            if since is None: return
+            hub = web_server.hub_dict[(room.room_id, 'vol')]
+            vol_telemetry = room.vol_telemetry
+            timeout = loop.time() + LONG_POLL_TIMEOUT
+            while since == vol_telemetry.seq:
+                now = loop.time()
+                if now >= timeout: break
+                if not await hub.wait(hub.future, timeout-now): break
+                metrics.LONG_POLL_WAKEUP_COUNT.inc('/vol')
+            data = vol_telemetry.get_packed_since(since, timeout=0)
+            self.send_response(200)
+            self.send_header('Content-type', 'application/octet-stream')
+            self.write(data)
+        elif path in ('/sample', '/sample_index'):
+            sample_storage = room.sample_storage
+            if sample_storage is None or not 'start' in parsed_query or not 'end' in parsed_query:
+                self.send_error(400, 'Bad request')
+                return
+            start_time = self.parse_query(parsed_query, 'start', float)
+            if start_time is None: return
+            end_time = self.parse_query(parsed_query, 'end', float)
+            if end_time is None: return
+            if path == '/sample':
+                data = await loop.run_in_executor(None, sample_storage.read_range_wav, start_time, end_time)
                 self.send_response(200)
-                self.send_header('Content-type', 'text/json')
-                self.end_headers()
-                self.wfile.write(bytes('{"result":"OK"}', "utf-8"))
+                self.send_header('Content-type', 'audio/wav')
+                self.write(data)
             else:
-                fn = parsed_path.path[1:]
-                if fn in self.server.smz_web_server.html_dict:
-                    self.send_response(200)
-                    self.send_header('Content-type', 'text/html')
-                    self.end_headers()
-                    self.wfile.write(self.server.smz_web_server.html_dict[fn])
-                else:
-                    self.send_response(404)
-                    self.send_header('Content-type', 'text/plain')
-                    self.end_headers()
-                    self.wfile.write(bytes('Not found', "utf-8"))
-        except:
-            traceback.print_exc()
+                data = {'sample_list': sample_storage.lookup(start_time, end_time)}
+                self.send_json(data)
+        elif path == '/room_list':
+            data = {'room_list': list(runtime.room_dict.keys())}
+            self.send_json(data)
+        elif path == '/metrics':
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.write(bytes(metrics.render(), "utf-8"))
+        elif path == '/set_trace':
+            tracing.TRACER.set_enabled(parsed_query.get('enable', ['0'])[0] == '1')
+            self.send_json({'result': 'OK'})
+        elif path == '/trace':
+            # Chrome / Perfetto trace of the spans recorded so far
+            data = await loop.run_in_executor(None, tracing.TRACER.dump)
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Disposition', 'attachment; filename="trace.json"')
+            self.write(bytes(data, "utf-8"))
+        elif path == '/lock_stat':
+            data = {'lock_stat_list': runtime.get_lock_stat_list()}
+            self.send_json(data)
+        elif path == '/audio_input_device_list':
+            refresh = parsed_query.get('refresh', ['0'])[0] == '1'
+            audio_input_device_list = await loop.run_in_executor(None, runtime.audio_input_device_registry.get_device_list, refresh)
+            data = {'audio_input_device_list': audio_input_device_list}
+            self.send_json(data)
+        elif path == '/set_audio_input_device':
+            if not 'hash' in parsed_query:
+                self.send_error(400, 'Bad request')
+                return
+            hash = parsed_query['hash'][0]
+            await loop.run_in_executor(None, room.set_audio_input_device_hash, hash)
+            self.send_json({'result': 'OK'})
+        elif path == '/enable':
+            await loop.run_in_executor(None, room.enable)
+            self.send_json({'result': 'OK'})
+        elif path == '/disable':
+            await loop.run_in_executor(None, room.disable)
+            self.send_json({'result': 'OK'})
+        elif path == '/set_config_dict':
+            if not 'config' in parsed_query:
+                self.send_error(400, 'Bad request')
+                return
+            config_dict_json_b64 = parsed_query['config'][0]
+            config_dict_json = base64.b64decode(config_dict_json_b64).decode('utf-8')
+            config_dict = json.loads(config_dict_json)
+            print(config_dict)
+            try:
+                await loop.run_in_executor(None, room.set_config_dict, config_dict)
+            except ValueError:
+                self.send_error(400, 'Bad request')
+                return
+            self.send_json({'result': 'OK'})
+        else:
+            fn = path[1:]
+            if fn in web_server.html_dict:
+                self.send_shared(web_server.html_dict[fn])
+            else:
+                self.route = 'other'
+                self.send_error(404, 'Not found')
+
+    async def send_event_stream(self, hub, read):
+        # read(last version or None) -> (version, event bytes or None), called after every change
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.start_stream()
+        version = None
+        while self.web_server.runtime.running:
+            future = hub.future
+            version, event = read(version)
+            if event is not None:
+                self.writer.write(event)
+            # a slow viewer is not read for while it drains, then gets the latest state only
+            await self.writer.drain()
+            if not await hub.wait(future, SSE_KEEPALIVE_TIMEOUT):
+                self.writer.write(b': keepalive\n\n')
+
+    def send_response(self, code):
+        self.status = code
+        self.header_list = []
+        self.body_list = []
+
+    def send_header(self, name, value):
+        self.header_list.append((name, value))
+
+    def write(self, data):
+        self.body_list.append(data)
+
+    def send_json(self, data):
+        self.send_response(200)
+        self.send_header('Content-type', 'text/json')
+        self.write(bytes(json.dumps(data), "utf-8"))
+
+    def make_json_response(self, data, *version_list):
+        etag = '"{}"'.format('-'.join(str(v) for v in (self.web_server.boot_id,) + version_list))
+        return SharedResponse(bytes(json.dumps(data), "utf-8"), 'text/json', etag)
+
+    def send_shared(self, response):
+        if response.etag in self.header_dict.get('if-none-match', ''):
+            self.send_response(304)
+            self.send_header('ETag', response.etag)
+            return
+        self.send_response(200)
+        self.send_header('Content-type', response.content_type)
+        self.send_header('ETag', response.etag)
+        self.send_header('Cache-Control', response.cache_control)
+        if len(response.body) < GZIP_MIN_SIZE:
+            self.write(response.body)
+            return
+        self.send_header('Vary', 'Accept-Encoding')
+        if 'gzip' in self.header_dict.get('accept-encoding', ''):
+            self.send_header('Content-Encoding', 'gzip')
+            self.write(response.get_gzip_body())
+        else:
+            self.write(response.body)
+
+    def parse_query(self, parsed_query, name, parse, default=None):
+        # parse (int, float) applied to the first value of name, default when it is absent;
+        # None once a value that does not parse has been answered with a 400
+        if name not in parsed_query:
+            return default
+        try:
+            return parse(parsed_query[name][0])
+        except ValueError:
+            self.send_error(400, 'Bad request')
+            return None
+
+    def send_error(self, code, message):
+        self.send_response(code)
+        self.send_header('Content-type', 'text/plain')
+        self.write(bytes(message, "utf-8"))
+
+    def start_stream(self):
+        # headers go out now, the body follows until the connection closes
+        self.streaming = True
+        self.keep_alive = False
+        self.writer.write(self._get_head(None))
+        metrics.HTTP_REQUEST_COUNT.inc(self.route, self.status)
+
+    async def finish(self):
+        metrics.HTTP_REQUEST_COUNT.inc(self.route, self.status)
+        body = b''.join(self.body_list)
+        self.writer.write(self._get_head(len(body)) + body)
+        await self.writer.drain()
+
+    def _get_head(self, content_length):
+        line_list = ['HTTP/1.1 {} {}'.format(self.status, http.HTTPStatus(self.status).phrase)]
+        for name, value in self.header_list:
+            line_list.append('{}: {}'.format(name, value))
+        if content_length is not None and self.status != 304:
+            line_list.append('Content-Length: {}'.format(content_length))
+        line_list.append('Connection: {}'.format('keep-alive' if self.keep_alive else 'close'))
+        return bytes('\r\n'.join(line_list) + '\r\n\r\n', 'latin-1')
+
+
+def make_event(data):
+    return bytes('data: {}\n\n'.format(json.dumps(data)), "utf-8")
+
+def diff_text(text, next_text):
+    # {'p': length of the kept prefix in UTF-16 code units, as JavaScript counts, 's': new suffix}
+    prefix = os.path.commonprefix([text, next_text])
+    return {'p': len(prefix.encode('utf-16-le')) // 2, 's': next_text[len(prefix):]}